@@ -1,12 +1,27 @@
 # api/query.py
+import atexit
+import contextlib
+import datetime
+import functools
+import hashlib
+import heapq
 import os
 import json
+import operator
+import queue
 import re
+import sqlite3
+import tempfile
+import threading
+import time
 import traceback
-from collections import Counter, defaultdict
-from http.server import BaseHTTPRequestHandler
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import quote as urlquote
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, Iterator
 
 # --------- Lazy imports for third-party libs (never at module import) ----------
 def _import_requests():
@@ -17,10 +32,17 @@ def _import_requests():
     except Exception as e:
         raise RuntimeError("'requests' not available: %s. Ensure it's in requirements.txt" % e)
 
+def _import_orjson_optional():
+    try:
+        import orjson  # type: ignore
+        return orjson
+    except Exception:
+        return None
+
 def _import_openai_optional():
     try:
-        import openai  # type: ignore
-        return openai
+        from openai import OpenAI  # type: ignore  # openai>=1.0
+        return OpenAI
     except Exception:
         return None
 
@@ -30,6 +52,7 @@ API_VERSION = "2025-08-29-sys-test-safe-v3a"
 # Environment
 # -----------------------------
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-3.5-turbo")
 
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
 AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
@@ -39,6 +62,20 @@ AZURE_SQL_SERVER = os.getenv("AZURE_SQL_SERVER")
 AZURE_SQL_DB = os.getenv("AZURE_SQL_DB")
 AZURE_SQL_USER = os.getenv("AZURE_SQL_USER")
 AZURE_SQL_PASSWORD = os.getenv("AZURE_SQL_PASSWORD")
+SQL_SCHEMA_HINT_FILE = os.getenv("SQL_SCHEMA_HINT_FILE")  # read once at import; wins over SQL_SCHEMA_HINT
+
+def _load_schema_hint() -> Tuple[str, Optional[str]]:
+    """(schema hint, why SQL_SCHEMA_HINT_FILE could not be used or None)."""
+    if SQL_SCHEMA_HINT_FILE:
+        try:
+            with open(SQL_SCHEMA_HINT_FILE, encoding="utf-8") as fh:
+                return fh.read().strip(), None
+        except OSError as e:
+            # Reported by GET and the test payload rather than falling back silently.
+            return os.getenv("SQL_SCHEMA_HINT", "(List allowed tables/views here)"), str(e)
+    return os.getenv("SQL_SCHEMA_HINT", "(List allowed tables/views here)"), None
+
+SQL_SCHEMA_HINT, SQL_SCHEMA_HINT_ERROR = _load_schema_hint()
 
 # Tunables
 DISABLE_AIRTABLE_SUMMARY = os.getenv("DISABLE_AIRTABLE_SUMMARY", "true").lower() == "true"
@@ -46,13 +83,82 @@ AIRTABLE_DEFAULT_LIMIT = int(os.getenv("AIRTABLE_DEFAULT_LIMIT", "50"))
 AIRTABLE_MAX_LIMIT = int(os.getenv("AIRTABLE_MAX_LIMIT", "1000"))
 AIRTABLE_SCAN_LIMIT = int(os.getenv("AIRTABLE_SCAN_LIMIT", "2000"))          # rows scanned for aggregations
 AIRTABLE_PAGE_SIZE_DEFAULT = int(os.getenv("AIRTABLE_PAGE_SIZE_DEFAULT", "50"))  # 1..100
+AIRTABLE_COLUMNS_TTL = float(os.getenv("AIRTABLE_COLUMNS_TTL", "300"))       # seconds discovered field names are reused
+AGG_CACHE_TTL = float(os.getenv("AGG_CACHE_TTL", "300"))                     # seconds an aggregation scan is reused; 0 disables
+AIRTABLE_FIELDS_SLIM = os.getenv("AIRTABLE_FIELDS_SLIM", "true").lower() == "true"  # photo listings fetch only the fields the UI shows
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", "512"))                      # generated-SQL cache entries
+SQL_CACHE_SIMILARITY = float(os.getenv("SQL_CACHE_SIMILARITY", "0.92"))       # cosine threshold for a hit
+SQL_CACHE_EMBED_DIMS = int(os.getenv("SQL_CACHE_EMBED_DIMS", "512"))          # embedding size requested for the cache
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))                # summarized-answer cache entries
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", os.path.join(tempfile.gettempdir(), "crm_llm_cache.sqlite3"))  # "" disables
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "86400"))                      # seconds a persisted completion stays valid
+AZURE_SQL_POOL_MAX = int(os.getenv("AZURE_SQL_POOL_MAX", "8"))                # idle SQL connections kept open
+AZURE_SQL_POOL_MIN = int(os.getenv("AZURE_SQL_POOL_MIN", "1"))                # connections opened at cold start
+SQL_POOL_PING_AFTER = float(os.getenv("SQL_POOL_PING_AFTER", "30"))           # idle seconds before a checkout is pinged
+SQL_FETCH_BATCH = int(os.getenv("SQL_FETCH_BATCH", "1000"))                   # rows per fetchmany()
+SQL_MAX_ROWS = max(1, int(os.getenv("SQL_MAX_ROWS", "1000")))                 # hard cap on rows read per query
+SUMMARY_MAX_COLUMNS = int(os.getenv("SUMMARY_MAX_COLUMNS", "8"))              # columns sent to the summarizer
+SUMMARY_MAX_CELL_CHARS = int(os.getenv("SUMMARY_MAX_CELL_CHARS", "200"))     # longer values are clipped in the prompt
+SQL_PARAMETERIZE = os.getenv("SQL_PARAMETERIZE", "true").lower() == "true"    # literals -> sp_executesql params
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", "65536"))                    # larger POST bodies are refused unread
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", "10"))            # questions accepted per {"questions": [...]}
 
-# OpenAI optional, no fail if missing
-_openai = _import_openai_optional()
-if _openai and OPENAI_API_KEY:
-    _openai.api_key = OPENAI_API_KEY
+# -----------------------------
+# Shared HTTP session (keep-alive across requests on a warm instance)
+# -----------------------------
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
 
-STATE_CODES = {"MA", "ME", "RI", "VT"}
+def _shared_http_session():
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                requests, _ = _import_requests()
+                from requests.adapters import HTTPAdapter  # type: ignore
+                from urllib3.util.retry import Retry  # type: ignore  # ships with requests
+                # Airtable allows ~5 requests/s per base; a multi-page scan can hit 429.
+                # GETs are retried with backoff (honouring Retry-After) instead of failing the request.
+                retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504),
+                              allowed_methods=frozenset({"GET"}), raise_on_status=False)
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+                _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+@atexit.register
+def _close_http_session() -> None:
+    if _HTTP_SESSION is not None:
+        _HTTP_SESSION.close()
+
+# orjson optional; stdlib json is the fallback
+_orjson = _import_orjson_optional()
+
+# OpenAI optional, no fail if missing. One client per process: it owns a pooled
+# keep-alive connection to api.openai.com that warm invocations reuse.
+_OpenAI = _import_openai_optional()
+
+def _openai_transport() -> Dict[str, Any]:
+    """Client kwargs: fail fast on connect, keep a few idle connections, and multiplex
+    over HTTP/2 when the optional h2 package is installed."""
+    try:
+        import httpx  # type: ignore  # installed with openai>=1.0
+    except Exception:
+        return {"timeout": 30.0}
+    try:
+        import h2  # type: ignore  # noqa: F401
+        http2 = True
+    except Exception:
+        http2 = False
+    # The SDK applies its own per-request timeout, so it is passed there too.
+    timeout = httpx.Timeout(30.0, connect=5.0)
+    return {"timeout": timeout,
+            "http_client": httpx.Client(http2=http2, timeout=timeout,
+                                        limits=httpx.Limits(max_keepalive_connections=8))}
+
+_openai = _OpenAI(api_key=OPENAI_API_KEY, max_retries=2, **_openai_transport()) if (_OpenAI and OPENAI_API_KEY) else None
+
+STATE_CODES = frozenset({"MA", "ME", "RI", "VT"})
 STATE_NAME_TO_CODE = {
     "massachusetts": "MA", "maine": "ME", "rhode island": "RI", "vermont": "VT",
     "ma": "MA", "me": "ME", "ri": "RI", "vt": "VT",
@@ -64,34 +170,61 @@ STATE_NAME_TO_CODE = {
 def _safe_to_str(val: Any) -> str:
     return val if isinstance(val, str) else ""
 
+def _json_default(o: Any) -> Any:
+    """Encode driver types (Decimal, date/time) that JSON has no native form for."""
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (datetime.date, datetime.time)):
+        return o.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
+
+# stdlib fallback, built once; compact UTF-8 output like orjson's.
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_json_default)
+
+def dumps_json(obj: Any, indent: bool = False) -> bytes:
+    if _orjson is not None:
+        option = _orjson.OPT_NON_STR_KEYS | (_orjson.OPT_INDENT_2 if indent else 0)
+        return _orjson.dumps(obj, default=_json_default, option=option)
+    if indent:
+        return json.dumps(obj, default=_json_default, ensure_ascii=False, indent=2).encode()
+    return _JSON_ENCODER.encode(obj).encode()
+
+def loads_json(raw: bytes) -> Any:
+    if _orjson is not None:
+        return _orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+_URL_SCHEMES = ("https://", "http://")
+
 def _to_url_list(value: Any) -> List[str]:
-    urls: List[str] = []
     if value is None:
-        return urls
-    items = value if isinstance(value, list) else [value]
+        return []
+    items = value if isinstance(value, list) else (value,)
+    urls: List[str] = []
+    # Inlined per element: this runs for every attachment of every scanned record.
     for x in items:
-        u = None
-        if isinstance(x, dict):
-            cand = x.get("url")
-            if isinstance(cand, str):
-                u = cand
-        elif isinstance(x, str):
-            u = x
-        u = _safe_to_str(u)
-        if u and u.lower().startswith("http"):
+        # Attachment objects carry "url"; URL/text fields come through as plain strings.
+        u = x.get("url") if isinstance(x, dict) else x
+        if isinstance(u, str) and u.startswith(_URL_SCHEMES):
             urls.append(u)
     return urls
 
+_PHOTO_FIELD_CANDIDATES = ("Photo", "Photos", "Attachment", "Attachments", "Images", "Image")
+
 def _normalize_photo_fields(fields: Dict[str, Any]) -> None:
     """Normalize attachments to list[str] in fields['Photo'] and set fields['first_photo_url']."""
-    candidates = ["Photo", "Photos", "Attachment", "Attachments", "Images", "Image"]
     found: List[str] = []
-    for key in candidates:
-        if key in fields:
-            urls = _to_url_list(fields.get(key))
-            fields[key] = urls
-            if not found and urls:
-                found = urls
+    for key in _PHOTO_FIELD_CANDIDATES:
+        value = fields.get(key)
+        if value is None:
+            # Absent, or an explicit null that normalizes to [] anyway.
+            if key in fields:
+                fields[key] = []
+            continue
+        urls = _to_url_list(value)
+        fields[key] = urls
+        if not found and urls:
+            found = urls
     if "Photo" not in fields:
         fields["Photo"] = found
     fields["first_photo_url"] = found[0] if found else None
@@ -114,8 +247,10 @@ def _airtable_sort_params(sort_list: Optional[List[str]]) -> Dict[str, str]:
 def _airtable_list_records(formula: Optional[str] = None,
                            sort: Optional[List[str]] = None,
                            page_size: int = 50,
-                           offset: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
-    requests, HTTPError = _import_requests()
+                           offset: Optional[str] = None,
+                           max_records: Optional[int] = None,
+                           fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    _import_requests()  # fail early with the install hint
     if not (AIRTABLE_API_KEY and AIRTABLE_BASE_ID and AIRTABLE_TABLE_NAME):
         return [], None
     url = "https://api.airtable.com/v0/%s/%s" % (AIRTABLE_BASE_ID, urlquote(AIRTABLE_TABLE_NAME))
@@ -126,46 +261,102 @@ def _airtable_list_records(formula: Optional[str] = None,
     params["pageSize"] = ps
     if offset:
         params["offset"] = offset
+    if max_records:
+        params["maxRecords"] = int(max_records)
+    if fields:
+        params["fields[]"] = list(fields)
     params.update(_airtable_sort_params(sort or []))
     headers = {"Authorization": "Bearer %s" % AIRTABLE_API_KEY}
-    resp = requests.get(url, headers=headers, params=params, timeout=20)
+    # Pooled session: pagination and warm requests reuse the TLS connection to api.airtable.com.
+    resp = _shared_http_session().get(url, headers=headers, params=params, timeout=20)
     resp.raise_for_status()
     data = resp.json()
     return data.get("records", []), data.get("offset")
 
-def _discover_columns() -> set:
+# Field names change on human timescales; one probe serves every request for AIRTABLE_COLUMNS_TTL.
+_COLUMNS_CACHE: Dict[str, Any] = {"cols": None, "ts": 0.0}
+_COLUMNS_LOCK = threading.Lock()
+
+def _discover_columns() -> frozenset:
+    with _COLUMNS_LOCK:
+        cols = _COLUMNS_CACHE["cols"]
+        if cols is not None and time.monotonic() - _COLUMNS_CACHE["ts"] < AIRTABLE_COLUMNS_TTL:
+            return cols
     try:
-        recs, _ = _airtable_list_records(page_size=1)
-        if recs:
-            return set((recs[0].get("fields") or {}).keys())
+        # Airtable omits empty fields from each record, so one record can miss real
+        # columns (a photo-less first row would drop Photo from every projection).
+        recs, _ = _airtable_list_records(page_size=100)
     except Exception:
-        pass
-    return set()
+        recs = []
+    if not recs:
+        # Failed (or empty table): not cached, so the next request probes again.
+        return frozenset()
+    cols = frozenset().union(*((r.get("fields") or {}).keys() for r in recs))
+    with _COLUMNS_LOCK:
+        _COLUMNS_CACHE["cols"], _COLUMNS_CACHE["ts"] = cols, time.monotonic()
+    return cols
+
+def _forget_columns() -> None:
+    """Drop the cached field names so the next request rediscovers them."""
+    with _COLUMNS_LOCK:
+        _COLUMNS_CACHE["cols"] = None
+
+# When Airtable rejects the fields[] projection, later pages and listings skip it for
+# AIRTABLE_COLUMNS_TTL instead of paying the failed request on every page.
+_PROJECTION_REJECTED: Dict[str, Optional[float]] = {"ts": None}
+
+def _projection_rejected() -> bool:
+    ts = _PROJECTION_REJECTED["ts"]
+    return ts is not None and time.monotonic() - ts < AIRTABLE_COLUMNS_TTL
+
+_STATE_FIELD_CANDIDATES = ("State", "state", "State Abbrev", "State Code")
+
+def _state_field() -> Optional[str]:
+    """The table's state column, from the cached field names."""
+    existing = _discover_columns()
+    return next((f for f in _STATE_FIELD_CANDIDATES if f in existing), None)
 
 def _build_formula_for_state(state: Optional[str]) -> Optional[str]:
     if not state or state not in STATE_CODES:
         return None
-    existing = _discover_columns()
-    candidates = ["State", "state", "State Abbrev", "State Code"]
-    usable = [f for f in candidates if f in existing]
-    if not usable:
+    field = _state_field()
+    if not field:
         return None
-    clauses = ['UPPER({%s})="%s"' % (name, state) for name in usable]
-    return "OR(" + ",".join(clauses) + ")"
+    return 'UPPER({%s})="%s"' % (field, state)
 
 def get_airtable_photos_page(state: Optional[str] = None,
                              page_size: int = 50,
-                             cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
-    requests, HTTPError = _import_requests()
+                             cursor: Optional[str] = None,
+                             max_records: Optional[int] = None,
+                             fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    _, HTTPError = _import_requests()
     formula = _build_formula_for_state(state)
     sort = ["-Date of Event"]
-    try:
-        recs, next_cursor = _airtable_list_records(formula=formula, sort=sort, page_size=page_size, offset=cursor)
-    except HTTPError as http_err:  # fall back if bad filter names
-        if getattr(http_err, "response", None) and http_err.response.status_code == 422:
-            recs, next_cursor = _airtable_list_records(formula=None, sort=sort, page_size=page_size, offset=cursor)
-        else:
-            raise
+    if fields and _projection_rejected():
+        fields = None
+    # On 422 (unknown field or filter name) retry without the field list, then without the filter.
+    attempts = [(formula, fields)]
+    if fields:
+        attempts.append((formula, None))
+    if formula:
+        attempts.append((None, None))
+    for i, (attempt_formula, attempt_fields) in enumerate(attempts):
+        try:
+            recs, next_cursor = _airtable_list_records(formula=attempt_formula, sort=sort, page_size=page_size,
+                                                       offset=cursor, max_records=max_records, fields=attempt_fields)
+            if fields and attempt_fields is None and attempt_formula == formula:
+                # Only dropping the projection fixed it.
+                _PROJECTION_REJECTED["ts"] = time.monotonic()
+            break
+        except HTTPError as http_err:
+            # A Response is falsy for 4xx, so compare against None explicitly.
+            resp = getattr(http_err, "response", None)
+            if resp is None or resp.status_code != 422:
+                raise
+            # A field named in the formula or projection is gone; don't keep asking for it.
+            _forget_columns()
+            if i == len(attempts) - 1:
+                raise
     rows: List[Dict[str, Any]] = []
     for r in recs:
         fields = r.get("fields") or {}
@@ -173,20 +364,38 @@ def get_airtable_photos_page(state: Optional[str] = None,
         rows.append(fields)
     return rows, next_cursor
 
-def fetch_airtable_records_for_aggregation(state: Optional[str] = None,
-                                           max_scan: int = AIRTABLE_SCAN_LIMIT) -> List[Dict[str, Any]]:
-    collected: List[Dict[str, Any]] = []
-    cursor: Optional[str] = None
-    while len(collected) < max_scan:
-        remaining = max_scan - len(collected)
-        page_size = min(100, remaining)
-        page, cursor = get_airtable_photos_page(state=state, page_size=page_size, cursor=cursor)
-        if not page:
-            break
-        collected.extend(page)
-        if not cursor:
+# Everything the aggregations and the photo grid read; the rest of each record is left on the server.
+_AGGREGATION_FIELDS = _PHOTO_FIELD_CANDIDATES + ("State", "state", "Event Name", "Date of Event",
+                                                "Employee First Name", "Employee Last Name",
+                                                "Submitted by Employee")
+
+def _projected_fields() -> Optional[List[str]]:
+    # Airtable rejects unknown names in fields[], so only ask for ones the table has.
+    existing = _discover_columns()
+    return [f for f in _AGGREGATION_FIELDS if f in existing] or None
+
+def iter_airtable_records_for_aggregation(state: Optional[str] = None,
+                                          max_scan: int = AIRTABLE_SCAN_LIMIT) -> Iterator[Dict[str, Any]]:
+    """Yield up to max_scan normalized records, one Airtable page in memory at a time.
+    The next page is requested in the background while the caller consumes this one."""
+    fields = _projected_fields()
+
+    def fetch(cursor: Optional[str], remaining: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        return get_airtable_photos_page(state=state, page_size=min(100, remaining), cursor=cursor,
+                                        max_records=max_scan, fields=fields)
+
+    scanned = 0
+    page, cursor = fetch(None, max_scan)
+    while page:
+        scanned += len(page)
+        # Pagination is cursor-based, so only one page can be in flight ahead of the consumer.
+        ahead: Optional[Future] = None
+        if cursor and scanned < max_scan:
+            ahead = _BACKGROUND.submit(fetch, cursor, max_scan - scanned)
+        yield from page
+        if ahead is None:
             break
-    return collected
+        page, cursor = ahead.result()
 
 def _first_string(x: Any) -> str:
     if isinstance(x, list) and x:
@@ -203,219 +412,1179 @@ def _extract_employee_name(fields: Dict[str, Any]) -> str:
         return "(Employee %s)" % sub[0]
     return "(Unknown)"
 
+def _first_value(x: Any) -> Any:
+    return x[0] if isinstance(x, list) and x else x
+
+def aggregate_all(state: Optional[str] = None) -> Dict[str, Any]:
+    """One scan of up to AIRTABLE_SCAN_LIMIT records, tallied for every aggregation at once
+    and reused per state for AGG_CACHE_TTL. Callers read the tallies; they must not modify them."""
+    if AGG_CACHE_TTL > 0:
+        cached = _AGG_CACHE.get(state)
+        if cached is not None:
+            return cached
+    employees: Counter = Counter()
+    states: Counter = Counter()
+    last_names: Counter = Counter()
+    events: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"count": 0, "states": Counter(), "dates": []})
+    scanned = 0
+    for r in iter_airtable_records_for_aggregation(state=state, max_scan=AIRTABLE_SCAN_LIMIT):
+        scanned += 1
+        st = _first_value(r.get("State") or r.get("state"))
+        if r.get("Photo"):
+            employees[_extract_employee_name(r)] += 1
+            states[(st or "Unknown").strip()] += 1
+            last_names[(_first_value(r.get("Employee Last Name")) or "Unknown").strip()] += 1
+        name = (r.get("Event Name") or "").strip()
+        if name:
+            group = events[name]
+            group["count"] += 1
+            event_state = (st or "").strip()
+            if event_state:
+                group["states"][event_state] += 1
+            d = r.get("Date of Event")
+            if isinstance(d, str) and d:
+                group["dates"].append(d)
+    tallies = {"scanned": scanned, "employees": employees, "states": states,
+               "last_names": last_names, "events": events}
+    if AGG_CACHE_TTL > 0:
+        _AGG_CACHE.put(state, tallies)
+    return tallies
+
 def aggregate_top_employees(state: Optional[str] = None, top_n: int = 10):
-    rows = fetch_airtable_records_for_aggregation(state=state, max_scan=AIRTABLE_SCAN_LIMIT)
-    counter = Counter()
-    for r in rows:
-        photos = r.get("Photo") or []
-        if isinstance(photos, list) and photos:
-            counter[_extract_employee_name(r)] += 1
-    return counter.most_common(top_n), len(rows)
+    tallies = aggregate_all(state)
+    return tallies["employees"].most_common(top_n), tallies["scanned"]
 
-def aggregate_counts_by_state(state: Optional[str] = None, top_n: Optional[int] = None):
-    rows = fetch_airtable_records_for_aggregation(state=state, max_scan=AIRTABLE_SCAN_LIMIT)
-    counter = Counter()
-    for r in rows:
-        photos = r.get("Photo") or []
-        if isinstance(photos, list) and photos:
-            st = r.get("State") or r.get("state") or "Unknown"
-            if isinstance(st, list) and st:
-                st = st[0]
-            counter[(st or "Unknown").strip()] += 1
+def _ranked_counts(counter: Counter, top_n: Optional[int]):
     items = counter.most_common(top_n) if top_n else counter.most_common()
     labels = [k for k, _ in items]
     data = [v for _, v in items]
     return labels, data, sum(counter.values())
 
+def aggregate_counts_by_state(state: Optional[str] = None, top_n: Optional[int] = None):
+    return _ranked_counts(aggregate_all(state)["states"], top_n)
+
 def aggregate_counts_by_employee_last_name(state: Optional[str] = None, top_n: Optional[int] = None):
-    rows = fetch_airtable_records_for_aggregation(state=state, max_scan=AIRTABLE_SCAN_LIMIT)
-    counter = Counter()
-    for r in rows:
-        photos = r.get("Photo") or []
-        if isinstance(photos, list) and photos:
-            last = r.get("Employee Last Name")
-            if isinstance(last, list) and last:
-                last = last[0]
-            counter[(last or "Unknown").strip()] += 1
-    items = counter.most_common(top_n) if top_n else counter.most_common()
-    labels = [k for k, _ in items]
-    data = [v for _, v in items]
-    return labels, data, sum(counter.values())
+    return _ranked_counts(aggregate_all(state)["last_names"], top_n)
 
 def aggregate_repeated_events(state: Optional[str] = None, min_count: int = 2, top_n: int = 25):
-    rows = fetch_airtable_records_for_aggregation(state=state, max_scan=AIRTABLE_SCAN_LIMIT)
-    groups: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"count": 0, "states": Counter(), "dates": []})
-    for r in rows:
-        name = (r.get("Event Name") or "").strip()
-        if not name:
-            continue
-        groups[name]["count"] += 1
-        st = r.get("State") or r.get("state") or ""
-        if isinstance(st, list) and st:
-            st = st[0]
-        st = (st or "").strip()
-        if st:
-            groups[name]["states"][st] += 1
-        d = r.get("Date of Event")
-        if isinstance(d, str) and d:
-            groups[name]["dates"].append(d)
-
+    tallies = aggregate_all(state)
     items: List[Dict[str, Any]] = []
-    for name, g in groups.items():
+    for name, g in tallies["events"].items():
         if g["count"] >= min_count:
-            states_sorted = sorted(g["states"].items(), key=lambda x: (-x[1], x[0]))
+            top_states = heapq.nsmallest(3, g["states"].items(), key=lambda x: (-x[1], x[0]))
             items.append({
                 "event_name": name,
                 "count": g["count"],
-                "top_states": ["%s (%d)" % (s, c) for s, c in states_sorted[:3]],
+                "top_states": ["%s (%d)" % (s, c) for s, c in top_states],
                 "first_date": min(g["dates"]) if g["dates"] else None,
                 "last_date": max(g["dates"]) if g["dates"] else None
             })
-    items.sort(key=lambda x: (-x["count"], x["event_name"]))
-    return items[:top_n], len(rows)
+    return heapq.nsmallest(top_n, items, key=lambda x: (-x["count"], x["event_name"])), tallies["scanned"]
+
+def format_top_employees_answer(top: List[Tuple[str, int]]) -> str:
+    if not top:
+        return "I didn’t find any photos."
+    leader, leader_count = top[0]
+    parts = ["%s has the most photos with %d." % (leader, leader_count)]
+    if len(top) > 1:
+        parts.append("Next: %s." % "; ".join("%s (%d)" % (n, c) for n, c in top[1:5]))
+    return " ".join(parts)
 
 # -----------------------------
 # Intent detection (FIXED)
 # -----------------------------
+_INTENT_KEYWORDS = (
+    "employee last name", "who has the most", "more than once", "most pictures", "most photos",
+    "by employee", "bar chart", "duplicates", "duplicate", "repeated", "employee", "airtable",
+    "event", "photo", "table", "count", "state",
+)
+# Questions mentioning any of these go to Airtable instead of SQL.
+_AIRTABLE_ROUTE_KEYWORDS = frozenset({"photo", "airtable", "event"})
+# Lookahead alternation: one left-to-right pass reports a (longest) keyword at every
+# offset; keywords nested inside a longer hit are added back via _IMPLIED_KEYWORDS.
+_INTENT_KEYWORD_RE = re.compile(
+    "(?=(%s))" % "|".join(re.escape(k) for k in sorted(_INTENT_KEYWORDS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
+_IMPLIED_KEYWORDS = {k: frozenset(o for o in _INTENT_KEYWORDS if o in k) for k in _INTENT_KEYWORDS}
+
+@functools.lru_cache(maxsize=256)
+def _intent_keywords(q: str) -> frozenset:
+    hits: set = set()
+    for m in _INTENT_KEYWORD_RE.finditer(q):
+        hits |= _IMPLIED_KEYWORDS[m.group(1).lower()]
+    return frozenset(hits)
+
 def is_employee_most_photos_intent(q: str) -> bool:
-    ql = q.lower()
-    return ("employee" in ql) and (("most photos" in ql) or ("most pictures" in ql) or ("who has the most" in ql))
+    kw = _intent_keywords(q)
+    return "employee" in kw and bool(kw & {"most photos", "most pictures", "who has the most"})
 
 def is_event_repeats_intent(q: str) -> bool:
-    ql = q.lower()
-    return ("event" in ql) and (("more than once" in ql) or ("repeated" in ql) or ("duplicates" in ql) or ("duplicate" in ql))
+    kw = _intent_keywords(q)
+    return "event" in kw and bool(kw & {"more than once", "repeated", "duplicates", "duplicate"})
 
 def is_bar_chart_by_state_intent(q: str) -> bool:
-    ql = q.lower()
-    return ("bar chart" in ql) and (("by state" in ql) or ("state" in ql))
+    kw = _intent_keywords(q)
+    return "bar chart" in kw and "state" in kw
 
 def is_bar_chart_by_employee_last_intent(q: str) -> bool:
-    ql = q.lower()
-    return ("bar chart" in ql) and (("employee last name" in ql) or ("by employee" in ql))
+    kw = _intent_keywords(q)
+    return "bar chart" in kw and bool(kw & {"employee last name", "by employee"})
 
 def is_table_counts_by_state_intent(q: str) -> bool:
-    ql = q.lower()
-    return ("table" in ql) and ("count" in ql) and ("state" in ql)
+    kw = _intent_keywords(q)
+    return "table" in kw and "count" in kw and "state" in kw
+
+# Checked in order; the first match wins.
+_AIRTABLE_INTENTS = (
+    ("top_employees", is_employee_most_photos_intent),
+    ("event_repeats", is_event_repeats_intent),
+    ("chart_by_state", is_bar_chart_by_state_intent),
+    ("chart_by_employee_last", is_bar_chart_by_employee_last_intent),
+    ("table_by_state", is_table_counts_by_state_intent),
+)
+
+def classify_question(q: str) -> str:
+    """"sql", "photos" (paged listing), or one of the _AIRTABLE_INTENTS names,
+    all from the single keyword pass cached by _intent_keywords."""
+    if not (_intent_keywords(q) & _AIRTABLE_ROUTE_KEYWORDS):
+        return "sql"
+    for kind, matches in _AIRTABLE_INTENTS:
+        if matches(q):
+            return kind
+    return "photos"
 
 # -----------------------------
 # SQL helpers (lazy import at call-time)
 # -----------------------------
-_SQL_BLOCKLIST = re.compile(r"(;|--|/\*|\*/|\\x| drop | alter | delete | insert | update | merge | exec | execute | xp_| sp_)", flags=re.IGNORECASE)
+# Checked against whole word tokens, so "DROP" after a newline, tab or "(" is caught
+# while column names such as updated_at are not. INTO blocks SELECT ... INTO.
+_SQL_BANNED_SUBSTRINGS = (";", "--", "/*", "*/", "\\x")
+_SQL_BANNED_TOKENS = frozenset({
+    "drop", "alter", "delete", "insert", "update", "merge", "exec", "execute", "truncate", "create",
+    "grant", "revoke", "deny", "into", "waitfor", "shutdown", "dbcc", "openrowset", "opendatasource",
+    "openquery",
+})
+_SQL_BANNED_PREFIXES = ("xp_", "sp_")
+_SQL_WORD_RE = re.compile(r"\w+")
+# String literals and [bracketed]/"quoted" identifiers are data, not keywords.
+_SQL_QUOTED_RE = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|\"[^\"]*\"")
+_SQL_SELECT_RE = re.compile(r"^\s*select\s", re.IGNORECASE)
 
-def run_sql(sql: str):
+def _import_pymssql():
     try:
         import pymssql  # type: ignore
+        return pymssql
     except Exception as ie:
         raise RuntimeError("SQL driver import failed: %s. Use a proxy or ensure FreeTDS/pymssql are available." % ie)
-    conn = None
+
+# Connections are kept open across requests on a warm instance; opening one
+# costs a TCP + TLS + login round-trip to Azure SQL. Entries are (conn, idle_since).
+_SQL_POOL: "queue.LifoQueue" = queue.LifoQueue(maxsize=max(1, AZURE_SQL_POOL_MAX))
+
+def _sql_connect():
+    pymssql = _import_pymssql()
+    return pymssql.connect(
+        server=AZURE_SQL_SERVER,
+        user=AZURE_SQL_USER,
+        password=AZURE_SQL_PASSWORD,
+        database=AZURE_SQL_DB,
+        login_timeout=5,
+        timeout=15,
+        autocommit=True,
+    )
+
+def _close_quietly(conn) -> None:
     try:
-        conn = pymssql.connect(
-            server=AZURE_SQL_SERVER,
-            user=AZURE_SQL_USER,
-            password=AZURE_SQL_PASSWORD,
-            database=AZURE_SQL_DB,
-            login_timeout=5,
-            timeout=15,
-        )
-        cur = conn.cursor(as_dict=True)
-        cur.execute(sql)
-        return cur.fetchall()
-    finally:
+        conn.close()
+    except Exception:
+        pass
+
+def _sql_conn_alive(conn) -> bool:
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchall()
+        return True
+    except Exception:
+        return False
+
+def _acquire_sql_conn():
+    while True:
         try:
-            if conn:
-                conn.close()
-        except Exception:
+            conn, idle_since = _SQL_POOL.get_nowait()
+        except queue.Empty:
+            return _sql_connect()
+        # Recently used connections skip the SELECT 1 round-trip; Azure only drops
+        # idle sessions after minutes, and a failure is still caught by run_sql.
+        if time.monotonic() - idle_since < SQL_POOL_PING_AFTER or _sql_conn_alive(conn):
+            return conn
+        _close_quietly(conn)
+
+def _release_sql_conn(conn, healthy: bool = True) -> None:
+    if healthy:
+        try:
+            _SQL_POOL.put_nowait((conn, time.monotonic()))
+            return
+        except queue.Full:
             pass
+    _close_quietly(conn)
+
+@contextlib.contextmanager
+def sql_connection(conn=None) -> Iterator[Any]:
+    """Check out a pooled connection (or adopt `conn`); returned on success, closed on error."""
+    if conn is None:
+        conn = _acquire_sql_conn()
+    healthy = False
+    try:
+        yield conn
+        healthy = True
+    finally:
+        _release_sql_conn(conn, healthy)
+
+@atexit.register
+def _drain_sql_pool() -> None:
+    while True:
+        try:
+            _close_quietly(_SQL_POOL.get_nowait()[0])
+        except queue.Empty:
+            return
+
+# String literals, comments and quoted identifiers are matched on their own so comparisons
+# inside them are left alone; otherwise a literal on the right of a comparison operator or
+# [NOT] LIKE becomes a parameter.
+_SQL_LITERAL_RE = re.compile(
+    r"(N?'(?:[^']|'')*'|--[^\n]*|/\*[\s\S]*?\*/|\[[^\]]*\]|\"[^\"]*\")"
+    r"|(?<=[\w\]\"])(\s*(?:<>|!=|<=|>=|=|<|>)\s*|\s+(?:NOT\s+)?LIKE\s+)(N?'(?:[^']|'')*'|-?\d+(?:\.\d+)?)(?![\w.])",
+    re.IGNORECASE,
+)
+
+def _sql_param_type(literal: str) -> Optional[Tuple[str, Any]]:
+    """(T-SQL type, Python value) for a literal, keeping the type SQL Server would infer;
+    None when no parameter type can hold it and it must stay inline."""
+    if literal[:2] in ("N'", "n'"):
+        text = literal[2:-1].replace("''", "'")
+        return ("nvarchar(4000)" if len(text) <= 4000 else "nvarchar(max)"), text
+    if literal.startswith("'"):
+        text = literal[1:-1].replace("''", "'")
+        return ("varchar(8000)" if len(text) <= 8000 else "varchar(max)"), text
+    if "." in literal:
+        digits = literal.lstrip("-")
+        scale = len(digits.split(".")[1])
+        precision = max(len(digits) - 1, scale, 1)
+        if precision > 38:  # SQL Server's maximum decimal precision
+            return None
+        return "decimal(%d,%d)" % (precision, scale), Decimal(literal)
+    value = int(literal)
+    return ("int" if -2**31 <= value < 2**31 else "bigint"), value
+
+def parameterize_sql(sql: str) -> Tuple[str, Optional[tuple]]:
+    """Rewrite comparison literals into an sp_executesql call so SQL Server reuses one
+    plan per query shape. Returns (sql, None) when there is nothing to parameterize."""
+    decls: List[str] = []
+    values: List[Any] = []
+    # One name per distinct literal: an expression repeated in SELECT and GROUP BY
+    # must stay textually identical or SQL Server rejects it (error 8120).
+    names: Dict[str, str] = {}
+
+    def _sub(m):
+        if m.group(1):
+            return m.group(1)
+        literal = m.group(3)
+        name = names.get(literal)
+        if name is None:
+            typed = _sql_param_type(literal)
+            if typed is None:
+                return m.group(0)
+            name = names[literal] = "@p%d" % len(values)
+            decls.append("%s %s" % (name, typed[0]))
+            values.append(typed[1])
+        return m.group(2) + name
+
+    stmt = _SQL_LITERAL_RE.sub(_sub, sql)
+    if not values:
+        return sql, None
+    # Statement and declarations are inlined (escaping % for the driver's formatter);
+    # only the literal values travel as driver parameters.
+    quote = lambda t: "N'%s'" % t.replace("'", "''").replace("%", "%%")
+    assigns = ", ".join("@p%d = %%s" % i for i in range(len(values)))
+    return ("EXEC sp_executesql %s, %s, %s" % (quote(stmt), quote(", ".join(decls)), assigns),
+            tuple(values))
+
+def _decimal_columns(description) -> Tuple[int, ...]:
+    decimal_type = _import_pymssql().DECIMAL
+    return tuple(i for i, d in enumerate(description) if d[1] == decimal_type)
+
+def _floats_at(row: tuple, idx: Tuple[int, ...]) -> list:
+    out = list(row)
+    for i in idx:
+        if out[i] is not None:
+            out[i] = float(out[i])
+    return out
+
+def iter_sql(sql: str, conn=None, max_rows: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Yield result rows as dicts, fetched SQL_FETCH_BATCH at a time. `conn` may be a
+    connection already checked out of the pool. Closing the generator early discards
+    the connection, since unread results would otherwise stay pending on it."""
+    limit = max(1, min(max_rows or SQL_MAX_ROWS, SQL_MAX_ROWS))
+    with sql_connection(conn) as conn:
+        cur = conn.cursor()
+        stmt, params = parameterize_sql(sql) if SQL_PARAMETERIZE else (sql, None)
+        # Server-side cap in the same batch, whether or not the model remembered TOP.
+        stmt = "SET ROWCOUNT %d; %s" % (limit, stmt)
+        if params:
+            cur.execute(stmt, params)
+        else:
+            cur.execute(stmt)
+        description = cur.description or []
+        cols = [d[0] for d in description]
+        # DECIMAL/MONEY columns become floats once here rather than through a
+        # per-value default() callback at serialization; datetimes are native to orjson.
+        decimal_idx = _decimal_columns(description)
+        remaining = limit if description else 0
+        while remaining > 0:
+            batch = cur.fetchmany(min(SQL_FETCH_BATCH, remaining))
+            if not batch:
+                break
+            remaining -= len(batch)
+            if decimal_idx:
+                batch = [_floats_at(row, decimal_idx) for row in batch]
+            for row in batch:
+                yield dict(zip(cols, row))
+
+def run_sql(sql: str, conn=None, max_rows: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Run a SELECT and return at most max_rows (default SQL_MAX_ROWS) rows."""
+    return list(iter_sql(sql, conn, max_rows))
+
+# Quoted strings/identifiers are consumed whole; a lone opening quote or bracket
+# left over means it was never closed.
+_SQL_DELIMITER_RE = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|\"[^\"]*\"|[()'\[\"]")
+
+def _sql_well_formed(sql: str) -> bool:
+    """Cheap local structure check so a reply truncated at max_tokens never costs a round-trip."""
+    depth = 0
+    for m in _SQL_DELIMITER_RE.finditer(sql):
+        tok = m.group(0)
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth -= 1
+            if depth < 0:
+                return False
+        elif len(tok) == 1:
+            return False
+    return depth == 0
 
 def is_safe_select(sql: str) -> bool:
-    if not sql:
+    # Anchored and cheapest, so it runs before any full scan of the text.
+    if not sql or not _SQL_SELECT_RE.match(sql):
+        return False
+    low = sql.lower()
+    if any(bad in low for bad in _SQL_BANNED_SUBSTRINGS):
+        return False
+    words = _SQL_WORD_RE.findall(_SQL_QUOTED_RE.sub(" ", low))
+    if not _SQL_BANNED_TOKENS.isdisjoint(words):
         return False
-    if _SQL_BLOCKLIST.search(sql):
+    # The per-token prefix scan only runs when a prefix occurs anywhere at all.
+    if ("xp_" in low or "sp_" in low) and any(w.startswith(_SQL_BANNED_PREFIXES) for w in words):
         return False
-    if not re.match(r"^\s*select\s", sql, flags=re.IGNORECASE):
+    if not _sql_well_formed(sql):
         return False
     return True
 
-def llm_generate_sql(question: str, schema_hint: str = "") -> str:
-    if not (_openai and OPENAI_API_KEY):
-        return "SELECT TOP 100 * FROM INFORMATION_SCHEMA.TABLES"
-    system = (
-        "Translate NL CRM questions into a single, safe, read-only T-SQL SELECT for Azure SQL. "
-        "Use only tables mentioned in the schema hint. "
-        "Return ONLY the SQL, no code fences, comments or semicolons. "
-        "Always include TOP 100."
-    )
-    user = "Question: %s\n\nSchema hint:\n%s" % (question, schema_hint)
-    resp = _openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+# -----------------------------
+# LLM response caches (in-process)
+# -----------------------------
+class _LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry,
+    and, when `ttl` is set, treats entries older than ttl seconds as absent."""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _fresh(self, stored_at: float, now: float) -> bool:
+        return self.ttl is None or now - stored_at < self.ttl
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if not self._fresh(entry[0], time.monotonic()):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def best(self, score, threshold: float) -> Any:
+        """Value with the highest score(value) above threshold, or None. Entries are
+        scored outside the lock, so a slow score() never stalls get/put."""
+        with self._lock:
+            now = time.monotonic()
+            live = [(key, value) for key, (stored_at, value) in self._data.items() if self._fresh(stored_at, now)]
+        best_key, best_value, best_score = None, None, threshold
+        for key, value in live:
+            sc = score(value)
+            if sc > best_score:
+                best_key, best_value, best_score = key, value, sc
+        if best_key is None:
+            return None
+        with self._lock:
+            if best_key in self._data:  # may have been evicted meanwhile
+                self._data.move_to_end(best_key)
+        return best_value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def put(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+# Same lifetime as the persisted tier, so a long-lived instance never outlives it.
+_SQL_CACHE = _LRUCache(SQL_CACHE_SIZE, ttl=LLM_CACHE_TTL)        # normalized question -> (unit embedding, sql, specifics)
+_ANSWER_CACHE = _LRUCache(ANSWER_CACHE_SIZE, ttl=LLM_CACHE_TTL)  # _prompt_key(model, prompt, question, rows) -> answer
+# Photo data moves on human timescales; every aggregation intent for a state shares one scan.
+_AGG_CACHE = _LRUCache(len(STATE_CODES) + 1, ttl=AGG_CACHE_TTL)  # state (None = all) -> aggregate_all tallies
+
+# Memoized: one request normalizes the same question for the SQL and answer cache keys.
+@functools.lru_cache(maxsize=256)
+def _normalize_question(q: str) -> str:
+    return " ".join(q.lower().split())
+
+# Cached embeddings are unit vectors quantized to int8 (x * 127): 1 byte per
+# component instead of a 24-byte Python float.
+_EMBED_SCALE = 127
+
+def _embed(q: str) -> Optional["array"]:
+    """Quantized unit-length embedding of a question, or None when embeddings are unavailable."""
+    try:
+        resp = _openai.embeddings.create(model="text-embedding-3-small", input=q,
+                                         dimensions=SQL_CACHE_EMBED_DIMS)
+        vec = resp.data[0].embedding
+    except Exception:
+        return None
+    norm = sum(x * x for x in vec) ** 0.5
+    if not norm:
+        return None
+    k = _EMBED_SCALE / norm
+    return array("b", [round(x * k) for x in vec])
+
+# Numbers, quoted strings and state names (as codes), in order of appearance.
+_SPECIFICS_RE = re.compile(r"\d+(?:\.\d+)?|\"[^\"]*\"|'[^']*'|\b(%s)\b"
+                           % "|".join(sorted(STATE_NAME_TO_CODE, key=len, reverse=True)))
+
+def _question_specifics(nq: str) -> Tuple[str, ...]:
+    """The tokens a similar-sounding question must repeat exactly to reuse cached SQL:
+    "applications in MA" and "... in VT" embed almost identically but need different SQL."""
+    return tuple(STATE_NAME_TO_CODE[m.group(1)] if m.group(1) else m.group(0)
+                 for m in _SPECIFICS_RE.finditer(nq))
+
+def _sql_cache_lookup(nq: str, vec: Optional["array"]) -> Optional[str]:
+    hit = _SQL_CACHE.get(nq)
+    if hit is None and vec is not None:
+        threshold = SQL_CACHE_SIMILARITY * _EMBED_SCALE * _EMBED_SCALE
+        specifics = _question_specifics(nq)
+        # A near neighbour with different numbers, strings or states is a miss.
+        hit = _SQL_CACHE.best(
+            lambda v: sum(map(operator.mul, v[0], vec)) if v[2] == specifics else float("-inf"), threshold)
+    return hit[1] if hit else None
+
+def _sql_cache_store(nq: str, vec: Optional["array"], sql: str) -> None:
+    _SQL_CACHE.put(nq, (vec or [], sql, _question_specifics(nq)))
+
+@functools.lru_cache(maxsize=8)
+def _prompt_prefix(model: str, system: str) -> "hashlib._Hash":
+    # The system prompts are built once at import, so their (multi-KB) digest
+    # state is computed once too and copied per request.
+    h = hashlib.sha256()
+    for piece in (model, system):
+        h.update(piece.encode())
+        h.update(b"\0")
+    return h
+
+def _provider_cache_key(label: str, system: str) -> str:
+    """OpenAI prompt_cache_key: routes calls sharing a system prompt to the same
+    prefix cache. Derived from the prompt so a schema change starts a new key."""
+    return "crm-%s-%s" % (label, _prompt_prefix(OPENAI_CHAT_MODEL, system).hexdigest()[:16])
+
+def _prompt_key(model: str, system: str, *parts: str) -> bytes:
+    """SHA-256 over everything that determines a deterministic completion."""
+    h = _prompt_prefix(model, system).copy()
+    for piece in parts:
+        h.update(piece.encode())
+        h.update(b"\0")
+    return h.digest()
+
+# Exact-match tier persisted to SQLite so warm restarts on the same instance keep it.
+_LLM_STORE = None
+_LLM_STORE_LOCK = threading.Lock()
+_LLM_STORE_FAILED = False
+
+def _llm_store():
+    global _LLM_STORE, _LLM_STORE_FAILED
+    if _LLM_STORE is None and LLM_CACHE_DB and not _LLM_STORE_FAILED:
+        try:
+            db = sqlite3.connect(LLM_CACHE_DB, check_same_thread=False, timeout=1.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key BLOB PRIMARY KEY, value TEXT, "
+                       "hits INTEGER DEFAULT 0, created REAL)")
+            db.commit()
+            _LLM_STORE = db
+        except Exception:
+            _LLM_STORE_FAILED = True  # read-only or missing filesystem: run without it
+    return _LLM_STORE
+
+def _store_get(key: bytes) -> Optional[str]:
+    with _LLM_STORE_LOCK:
+        db = _llm_store()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT value FROM llm_cache WHERE key=? AND created > ?",
+                             (key, time.time() - LLM_CACHE_TTL)).fetchone()
+            if row:
+                db.execute("UPDATE llm_cache SET hits = hits + 1 WHERE key=?", (key,))
+                db.commit()
+            return row[0] if row else None
+        except sqlite3.Error:
+            return None
+
+def _store_put(key: bytes, value: str) -> None:
+    if not value.strip():
+        return
+    with _LLM_STORE_LOCK:
+        db = _llm_store()
+        if db is None:
+            return
+        try:
+            db.execute("INSERT OR REPLACE INTO llm_cache (key, value, hits, created) VALUES (?, ?, 0, ?)",
+                       (key, value, time.time()))
+            db.commit()
+        except sqlite3.Error:
+            pass
+
+_SQL_SYSTEM_PREAMBLE = (
+    "Translate NL CRM questions into a single, safe, read-only T-SQL SELECT for Azure SQL. "
+    "Use only tables mentioned in the schema hint. "
+    "Return ONLY the SQL, no code fences, comments or semicolons. "
+    "Always include TOP 100."
+)
+
+def _build_sql_system_prompt(schema_hint: str) -> str:
+    return "%s\n\nSchema hint:\n%s" % (_SQL_SYSTEM_PREAMBLE, schema_hint)
+
+# Built once; the schema hint is static for the lifetime of the process.
+_SQL_SYSTEM_PROMPT = _build_sql_system_prompt(SQL_SCHEMA_HINT)
+
+# Questions whose SQL does not depend on the model; checked before any OpenAI call.
+# Anchored to the whole question so data questions that merely mention "views",
+# "tables" or "fields" ("listings with the most views") still go to the model.
+_SCHEMA_ASK = r"^\s*(?:list|show(?:\s+me)?|what\s+are|which\s+are|what|which)\s+(?:all\s+)?(?:the\s+)?"
+_SCHEMA_TAIL = r"(?:\s+(?:are\s+there|exist|are\s+in\s+the\s+database|in\s+the\s+database))?\s*\??\s*$"
+_FAST_PATHS: List[Tuple[Any, str]] = [
+    (re.compile(_SCHEMA_ASK + r"(?:columns|fields)(?:\s+(?:are|exist))?\s+(?:in|of|for|on)\s+(?:the\s+)?(?:table\s+)?"
+                r"\[?([A-Za-z_][A-Za-z0-9_]*)\]?(?:\s+table)?\s*\??\s*$", re.IGNORECASE),
+     "SELECT TOP 100 TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS "
+     "WHERE TABLE_NAME = '%s' ORDER BY ORDINAL_POSITION"),
+    (re.compile(_SCHEMA_ASK + r"(?:database\s+)?views" + _SCHEMA_TAIL, re.IGNORECASE),
+     "SELECT TOP 100 TABLE_SCHEMA, TABLE_NAME FROM INFORMATION_SCHEMA.VIEWS ORDER BY TABLE_SCHEMA, TABLE_NAME"),
+    (re.compile(_SCHEMA_ASK + r"(?:database\s+)?tables" + _SCHEMA_TAIL, re.IGNORECASE),
+     "SELECT TOP 100 TABLE_SCHEMA, TABLE_NAME, TABLE_TYPE FROM INFORMATION_SCHEMA.TABLES ORDER BY TABLE_SCHEMA, TABLE_NAME"),
+]
+
+def fast_path_sql(question: str) -> Optional[str]:
+    for pattern, template in _FAST_PATHS:
+        m = pattern.search(question)
+        if m:
+            return template % m.groups() if m.groups() else template
+    return None
+
+# Cleanup applied to every model reply before it is validated.
+# A fenced block is taken wherever it sits, so prose around it is dropped too;
+# an unclosed fence (truncated reply) just loses its marker.
+_CODE_FENCE_RE = re.compile(r"```[a-zA-Z]*[ \t]*\n?(.*?)```|```[a-zA-Z]*", re.DOTALL)
+# Line and block comments in one left-to-right pass.
+_SQL_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_TOP_RE = re.compile(r"\bTOP\s+\d+\b", re.IGNORECASE)
+_SELECT_HEAD_RE = re.compile(r"^\s*select\s+(distinct\s+)?", re.IGNORECASE)
+
+def _add_top(m: "re.Match") -> str:
+    return "SELECT %sTOP 100 " % (m.group(1) or "").upper()
+
+_NO_LLM_SQL = "SELECT TOP 100 * FROM INFORMATION_SCHEMA.TABLES"
+
+def _clean_generated_sql(text: str) -> str:
+    sql = (text or "").strip()
+    fenced = _CODE_FENCE_RE.search(sql)
+    if fenced is not None:
+        sql = (fenced.group(1) if fenced.group(1) is not None else _CODE_FENCE_RE.sub("", sql)).strip()
+    sql = _SQL_COMMENT_RE.sub("", sql)
+    sql = sql.split(";")[0].strip()
+    if _TOP_RE.search(sql) is None:
+        sql = _SELECT_HEAD_RE.sub(_add_top, sql, count=1)
+    return sql
+
+def _cached_sql(nq: str, store_key: bytes) -> Tuple[Optional[str], Optional["array"]]:
+    """(cached SQL or None, the question's embedding if one was computed for the lookup)."""
+    cached = _sql_cache_lookup(nq, None)
+    if cached is None:
+        cached = _store_get(store_key)
+        if cached is not None:
+            _sql_cache_store(nq, None, cached)
+    vec: Optional["array"] = None
+    if cached is None:
+        vec = _embed(nq)
+        if vec is not None:
+            cached = _sql_cache_lookup(nq, vec)
+    return cached, vec
+
+def _remember_sql(nq: str, vec: Optional["array"], store_key: bytes, sql: str) -> None:
+    # Never cache a reply that would be rejected; the next ask gets a fresh completion.
+    if is_safe_select(sql):
+        _sql_cache_store(nq, vec, sql)
+        _store_put(store_key, sql)
+
+def _complete_sql(system: str, question: str) -> str:
+    resp = _openai.chat.completions.create(
+        model=OPENAI_CHAT_MODEL,
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": "Question: %s" % question}],
         temperature=0.0,
         max_tokens=300,
+        extra_body={"prompt_cache_key": _provider_cache_key("sql", system)},
     )
-    sql = resp.choices[0].message.content.strip()
-    sql = re.sub(r"^```[a-zA-Z]*", "", sql).strip()
-    sql = re.sub(r"```$", "", sql).strip()
-    sql = re.sub(r"--.*?$", "", sql, flags=re.MULTILINE)
-    sql = re.sub(r"/\*.*?\*/", "", sql, flags=re.DOTALL)
-    sql = sql.split(";")[0].strip()
-    if re.search(r"\bTOP\s+\d+\b", sql, flags=re.IGNORECASE) is None:
-        sql = re.sub(r"^\s*select\s", "SELECT TOP 100 ", sql, flags=re.IGNORECASE)
+    return _clean_generated_sql(resp.choices[0].message.content or "")
+
+def llm_generate_sql(question: str, schema_hint: Optional[str] = None) -> str:
+    fast = fast_path_sql(question)
+    if fast:
+        return fast
+    if not (_openai and OPENAI_API_KEY):
+        return _NO_LLM_SQL
+    # Caches only apply to the deployment's own schema hint.
+    if schema_hint is not None and schema_hint != SQL_SCHEMA_HINT:
+        return _complete_sql(_build_sql_system_prompt(schema_hint), question)
+    nq = _normalize_question(question)
+    # Persisted SQL is only reused while the model and prompt (instructions + schema) are unchanged.
+    store_key = _prompt_key(OPENAI_CHAT_MODEL, _SQL_SYSTEM_PROMPT, nq)
+    cached, vec = _cached_sql(nq, store_key)
+    if cached is not None:
+        return cached
+    sql = _complete_sql(_SQL_SYSTEM_PROMPT, question)
+    _remember_sql(nq, vec, store_key, sql)
     return sql
 
-def llm_format_answer(question: str, sample_rows: list) -> str:
+_SQL_BATCH_SYSTEM_PROMPT = (
+    "%s\n\nThe user sends several numbered questions. Reply with a JSON object "
+    "{\"sql\": [...]} holding one SQL string per question, in the same order; "
+    "each string follows the rules above." % _SQL_SYSTEM_PROMPT
+)
+
+def _complete_sql_batch(questions: List[str]) -> Optional[List[str]]:
+    """One completion for several questions, or None if the call fails or the reply does
+    not line up; the caller then asks per question."""
+    numbered = "\n".join("%d. %s" % (n, q) for n, q in enumerate(questions, 1))
+    try:
+        # A model without JSON mode, or a max_tokens it rejects, fails here with a 400.
+        resp = _openai.chat.completions.create(
+            model=OPENAI_CHAT_MODEL,
+            messages=[{"role": "system", "content": _SQL_BATCH_SYSTEM_PROMPT}, {"role": "user", "content": numbered}],
+            temperature=0.0,
+            max_tokens=300 * len(questions),
+            response_format={"type": "json_object"},
+            extra_body={"prompt_cache_key": _provider_cache_key("sql-batch", _SQL_BATCH_SYSTEM_PROMPT)},
+        )
+    except Exception:
+        return None
+    try:
+        items = loads_json((resp.choices[0].message.content or "").encode())["sql"]
+    except Exception:
+        return None
+    if not isinstance(items, list) or len(items) != len(questions) or not all(isinstance(x, str) for x in items):
+        return None
+    return [_clean_generated_sql(x) for x in items]
+
+def llm_generate_sql_batch(questions: List[str]) -> List[str]:
+    """llm_generate_sql for each question; the cache misses share a single chat completion."""
+    out: List[str] = []
+    misses: List[Tuple[int, str, Optional["array"], bytes]] = []  # (index, nq, vec, store_key)
+    for i, question in enumerate(questions):
+        sql = fast_path_sql(question)
+        if not sql and not (_openai and OPENAI_API_KEY):
+            sql = _NO_LLM_SQL
+        if not sql:
+            nq = _normalize_question(question)
+            store_key = _prompt_key(OPENAI_CHAT_MODEL, _SQL_SYSTEM_PROMPT, nq)
+            sql, vec = _cached_sql(nq, store_key)
+            if sql is None:
+                misses.append((i, nq, vec, store_key))
+        out.append(sql or "")
+    if not misses:
+        return out
+    pending = [questions[i] for i, _, _, _ in misses]
+    replies = _complete_sql_batch(pending) if len(pending) > 1 else None
+    if replies is None:
+        replies = [_complete_sql(_SQL_SYSTEM_PROMPT, q) for q in pending]
+    for (i, nq, vec, store_key), sql in zip(misses, replies):
+        out[i] = sql
+        _remember_sql(nq, vec, store_key, sql)
+    return out
+
+def _sql_configured() -> bool:
+    return bool(AZURE_SQL_SERVER and AZURE_SQL_DB and AZURE_SQL_USER and AZURE_SQL_PASSWORD)
+
+# Background I/O that can overlap an OpenAI round-trip.
+_BACKGROUND = ThreadPoolExecutor(max_workers=4, thread_name_prefix="crm-bg")
+
+def _prewarm_sql_pool(n: int) -> None:
+    """Open up to n idle connections; a failure is left for the first query to surface."""
+    for _ in range(n):
+        try:
+            conn = _sql_connect()
+        except Exception:
+            return
+        _release_sql_conn(conn)
+
+# Cold starts begin the Azure SQL login in the background, off the first request's path.
+if AZURE_SQL_POOL_MIN > 0 and _sql_configured():
+    _BACKGROUND.submit(_prewarm_sql_pool, min(AZURE_SQL_POOL_MIN, AZURE_SQL_POOL_MAX))
+
+def _release_when_done(fut: Future) -> None:
+    def _cb(f: Future) -> None:
+        if not f.cancelled() and f.exception() is None:
+            _release_sql_conn(f.result())
+    fut.add_done_callback(_cb)
+
+def generate_sql_with_connection(question: str) -> Tuple[str, Any]:
+    """llm_generate_sql, while a pooled SQL connection is checked out in the background.
+
+    Returns (sql, conn); conn is None if SQL is not configured or the checkout failed,
+    in which case run_sql connects on its own and surfaces the error.
+    """
+    fut = _BACKGROUND.submit(_acquire_sql_conn) if _sql_configured() else None
+    try:
+        sql = llm_generate_sql(question)
+    except Exception:
+        if fut is not None:
+            _release_when_done(fut)
+        raise
+    conn = None
+    if fut is not None:
+        try:
+            conn = fut.result()
+        except Exception:
+            conn = None
+    return sql, conn
+
+# Static system prompts go first, unchanged between calls, so OpenAI's
+# automatic prefix cache can match them; only the user message varies.
+_SUMMARY_SYSTEM_PROMPT = "Summarize the data into a direct, business-friendly answer (1–2 sentences)."
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+def _pick_relevant_columns(rows: List[Dict[str, Any]], question: str) -> List[str]:
+    """Columns worth sending to the summarizer: the first (key) column, any the
+    question mentions, then the densest remaining ones, up to SUMMARY_MAX_COLUMNS."""
+    cols = list(rows[0].keys())
+    if len(cols) <= SUMMARY_MAX_COLUMNS:
+        return cols
+    q_tokens = set(_WORD_RE.findall(question.lower()))
+    picked = [cols[0]]
+    picked += [c for c in cols[1:] if q_tokens & set(_WORD_RE.findall(c.lower()))]
+    by_density = sorted(cols, key=lambda c: -sum(1 for r in rows if r.get(c) not in (None, "")))
+    for c in by_density:
+        if len(picked) >= SUMMARY_MAX_COLUMNS:
+            break
+        if c not in picked:
+            picked.append(c)
+    keep = set(picked[:SUMMARY_MAX_COLUMNS])
+    return [c for c in cols if c in keep]
+
+_PROSE_RE = re.compile(r"\b(explain|summari[sz]e|describe|why|compare)\b", re.IGNORECASE)
+_TOP_N_RE = re.compile(r"\btop\s+(\d+)\b", re.IGNORECASE)
+_DIRECT_LIST_MAX = 20    # short label/count lists and single-column lists are read out as-is
+
+def _is_number(v: Any) -> bool:
+    return isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)
+
+def _fmt_value(v: Any) -> str:
+    if isinstance(v, (datetime.date, datetime.time)):
+        return v.isoformat()
+    return "(none)" if v is None else str(v)
+
+def _fmt_measure(v: Any) -> str:
+    # Group separators only for counts/sums; years, IDs and ZIP codes go through _fmt_value.
+    return format(v, ",") if _is_number(v) else _fmt_value(v)
+
+def format_answer_directly(question: str, rows: List[Dict[str, Any]]) -> Optional[str]:
+    """Render results whose shape makes the answer obvious; None means ask the LLM."""
+    if not rows or _PROSE_RE.search(question):
+        return None
+    cols = list(rows[0].keys())
+    if len(rows) == 1 and len(cols) == 1 and _is_number(rows[0][cols[0]]):
+        return "The %s is %s." % (cols[0] or "result", _fmt_value(rows[0][cols[0]]))
+    if len(rows) == 1:
+        return "Found 1 result: %s." % "; ".join("%s: %s" % (c, _fmt_value(rows[0][c])) for c in cols)
+    if len(cols) == 2 and len(rows) <= _DIRECT_LIST_MAX and all(_is_number(r[cols[1]]) for r in rows):
+        # Rows stay in the SQL's ORDER BY and are never cut, whichever way the question ranks.
+        items = "; ".join("%s (%s)" % (_fmt_value(r[cols[0]]), _fmt_measure(r[cols[1]])) for r in rows)
+        top_n = _TOP_N_RE.search(question)
+        if top_n:
+            return "Top %s %s by %s: %s." % (top_n.group(1), cols[0], cols[1], items)
+        return "%s by %s: %s." % (cols[1] or "Result", cols[0], items)
+    if len(cols) == 1 and len(rows) <= _DIRECT_LIST_MAX:
+        return "Found %d results: %s." % (len(rows), ", ".join(_fmt_value(r[cols[0]]) for r in rows))
+    return None
+
+def _summary_cell(v: Any) -> str:
+    # Raw values: the model reads IDs and years as written.
+    text = str(v).replace("\n", " ")
+    # One long free-text column should not dominate the prompt.
+    if len(text) > SUMMARY_MAX_CELL_CHARS:
+        text = text[:SUMMARY_MAX_CELL_CHARS] + "…"
+    return text
+
+def _summary_rows_text(question: str, sample_rows: list) -> str:
+    """Pipe-delimited table: the header once, then one line per row. Roughly a
+    third of the prompt tokens of indented JSON, which repeats every key."""
+    sample = sample_rows[:5]
+    cols = _pick_relevant_columns(sample, question)
+    lines = [" | ".join(cols)]
+    lines.extend(" | ".join(_summary_cell(r.get(c)) for c in cols) for r in sample)
+    return "\n".join(lines)
+
+def _summary_messages(question: str, rows_text: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": _SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": "Question: %s\n\nRows:\n%s" % (question, rows_text)},
+    ]
+
+def _answer_cache_key(question: str, rows_text: str) -> bytes:
+    # Keyed on the exact rows summarized, so changed data never reuses a stale answer.
+    return _prompt_key(OPENAI_CHAT_MODEL, _SUMMARY_SYSTEM_PROMPT, _normalize_question(question), rows_text)
+
+def _answer_cache_get(key: bytes) -> Optional[str]:
+    hit = _ANSWER_CACHE.get(key)
+    if hit is None:
+        hit = _store_get(key)
+        if hit is not None:
+            _ANSWER_CACHE.put(key, hit)
+    return hit
+
+def _answer_cache_put(key: bytes, answer: str) -> None:
+    # An empty completion (filtered, truncated, or a dropped stream) is not an answer;
+    # the next ask gets a fresh one instead of replaying the blank.
+    if not answer.strip():
+        return
+    _ANSWER_CACHE.put(key, answer)
+    _store_put(key, answer)
+
+def _answer_without_llm(question: str, sample_rows: list) -> Optional[str]:
     if not sample_rows:
         return "No results found for your question."
+    direct = format_answer_directly(question, sample_rows)
+    if direct is not None:
+        return direct
     if not (_openai and OPENAI_API_KEY):
-        return json.dumps(sample_rows[:5], indent=2)
-    resp = _openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Summarize the data into a direct, business-friendly answer (1–2 sentences)."},
-            {"role": "user", "content": "Question: %s\n\nRows:\n%s" % (question, json.dumps(sample_rows[:5], indent=2))},
-        ],
+        return dumps_json(sample_rows[:5], indent=True).decode()
+    return None
+
+def llm_format_answer(question: str, sample_rows: list) -> str:
+    local = _answer_without_llm(question, sample_rows)
+    if local is not None:
+        return local
+    rows_text = _summary_rows_text(question, sample_rows)
+    key = _answer_cache_key(question, rows_text)
+    cached = _answer_cache_get(key)
+    if cached is not None:
+        return cached
+    resp = _openai.chat.completions.create(
+        model=OPENAI_CHAT_MODEL,
+        messages=_summary_messages(question, rows_text),
         temperature=0.2,
         max_tokens=300,
+        extra_body={"prompt_cache_key": _provider_cache_key("summary", _SUMMARY_SYSTEM_PROMPT)},
     )
-    return resp.choices[0].message.content.strip()
+    answer = (resp.choices[0].message.content or "").strip()
+    _answer_cache_put(key, answer)
+    return answer
+
+def llm_stream_answer(question: str, sample_rows: list) -> Iterator[str]:
+    """Like llm_format_answer, but yields the summary as it is generated."""
+    local = _answer_without_llm(question, sample_rows)
+    if local is not None:
+        yield local
+        return
+    rows_text = _summary_rows_text(question, sample_rows)
+    key = _answer_cache_key(question, rows_text)
+    cached = _answer_cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+    stream = _openai.chat.completions.create(
+        model=OPENAI_CHAT_MODEL,
+        messages=_summary_messages(question, rows_text),
+        temperature=0.2,
+        max_tokens=300,
+        extra_body={"prompt_cache_key": _provider_cache_key("summary", _SUMMARY_SYSTEM_PROMPT)},
+        stream=True,
+    )
+    parts: List[str] = []
+    for chunk in stream:
+        piece = chunk.choices[0].delta.content if chunk.choices else None
+        if piece:
+            parts.append(piece)
+            yield piece
+    _answer_cache_put(key, "".join(parts).strip())
 
 # -----------------------------
 # Status
 # -----------------------------
+# Environment-derived fields are fixed for the life of the process.
+_STATIC_CONFIG_STATUS: Dict[str, Any] = {
+    "api_version": API_VERSION,
+    "airtable_configured": bool(AIRTABLE_API_KEY and AIRTABLE_BASE_ID and AIRTABLE_TABLE_NAME),
+    "sql_configured": _sql_configured(),
+    "sql_schema_hint_error": SQL_SCHEMA_HINT_ERROR,
+    "openai_configured": bool(OPENAI_API_KEY),
+    "disable_airtable_summary": DISABLE_AIRTABLE_SUMMARY,
+    "airtable_default_limit": AIRTABLE_DEFAULT_LIMIT,
+    "airtable_max_limit": AIRTABLE_MAX_LIMIT,
+    "airtable_scan_limit": AIRTABLE_SCAN_LIMIT,
+    "airtable_page_size_default": AIRTABLE_PAGE_SIZE_DEFAULT,
+    "airtable_fields_slim": AIRTABLE_FIELDS_SLIM,
+    "sql_max_rows": SQL_MAX_ROWS,
+}
+
 def config_status() -> Dict[str, Any]:
     return {
-        "api_version": API_VERSION,
-        "airtable_configured": bool(AIRTABLE_API_KEY and AIRTABLE_BASE_ID and AIRTABLE_TABLE_NAME),
-        "sql_configured": bool(AZURE_SQL_SERVER and AZURE_SQL_DB and AZURE_SQL_USER and AZURE_SQL_PASSWORD),
-        "openai_configured": bool(OPENAI_API_KEY),
-        "disable_airtable_summary": DISABLE_AIRTABLE_SUMMARY,
-        "airtable_default_limit": AIRTABLE_DEFAULT_LIMIT,
-        "airtable_max_limit": AIRTABLE_MAX_LIMIT,
-        "airtable_scan_limit": AIRTABLE_SCAN_LIMIT,
-        "airtable_page_size_default": AIRTABLE_PAGE_SIZE_DEFAULT,
+        **_STATIC_CONFIG_STATUS,
+        "sql_cache_entries": len(_SQL_CACHE),
+        "answer_cache_entries": len(_ANSWER_CACHE),
+        "aggregation_cache_entries": len(_AGG_CACHE),
     }
 
+def _probe_airtable() -> List[Dict[str, Any]]:
+    try:
+        recs, _ = _airtable_list_records(page_size=1)  # intentionally small
+        sample = []
+        for r in recs:
+            before = r.get("fields") or {}
+            # Normalization rebinds keys rather than mutating values, so one shallow copy suffices.
+            after = dict(before)
+            _normalize_photo_fields(after)
+            sample.append({"before": before, "after": after})
+        return sample
+    except Exception as e:
+        return [{"error": str(e)}]
+
+def _probe_sql() -> Dict[str, Any]:
+    if not _sql_configured():
+        return {"ok": False, "error": "SQL is not configured"}
+    try:
+        started = time.monotonic()
+        with sql_connection() as conn:
+            if not _sql_conn_alive(conn):
+                raise RuntimeError("SELECT 1 failed")
+        return {"ok": True, "ms": round((time.monotonic() - started) * 1000, 1)}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+# debug value -> (payload key, probe); "all" runs every probe concurrently.
+_PROBES = {"airtable": ("airtable_sample", _probe_airtable), "sql": ("sql_probe", _probe_sql)}
+_PROBE_TIMEOUT = 10
+
+def run_probes(debug: Any) -> Dict[str, Any]:
+    if debug == "all":
+        names = list(_PROBES)
+    else:
+        names = [debug] if isinstance(debug, str) and debug in _PROBES else []
+    futures = {_PROBES[n][0]: _BACKGROUND.submit(_PROBES[n][1]) for n in names}
+    out: Dict[str, Any] = {}
+    for key, fut in futures.items():
+        try:
+            out[key] = fut.result(timeout=_PROBE_TIMEOUT)
+        except Exception as e:
+            out[key] = {"error": "probe did not finish: %s" % (e or type(e).__name__)}
+    return out
+
 # -----------------------------
 # HTTP handler
 # -----------------------------
+_RAW_RESULTS_MAX = 200
+
+def _sql_results(sql: str, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # The row dicts are shared with the summary, not copied; orjson serializes them in one pass.
+    raw = rows if len(rows) <= _RAW_RESULTS_MAX else rows[:_RAW_RESULTS_MAX]
+    return {"query_type": "sql", "sql": sql, "raw_results": raw, "results_count": len(rows), "next_cursor": None}
+
+def _stream_sql_frames(question: str, sql: str, rows: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Results first, then summary tokens, then the assembled answer."""
+    yield {"type": "results", **_sql_results(sql, rows)}
+    parts: List[str] = []
+    for piece in llm_stream_answer(question, rows):
+        parts.append(piece)
+        yield {"type": "token", "v": piece}
+    yield {"type": "done", "answer": "".join(parts).strip()}
+
+def _airtable_response(kind: str, question: str, data: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    """(status, payload) for a question classify_question() routed to Airtable."""
+    state, overall_limit = parse_state_and_limit(question)
+
+    if kind == "top_employees":
+        top, scanned = aggregate_top_employees(state=state, top_n=10)
+        ans = format_top_employees_answer(top)
+        return 200, {"answer": ans, "query_type": "airtable", "sql": None,
+                     "raw_results": [], "results_count": scanned, "next_cursor": None}
+
+    if kind == "event_repeats":
+        items, scanned = aggregate_repeated_events(state=state, min_count=2, top_n=25)
+        ans = "No events were found more than once." if not items else "Found %d events that occurred more than once." % len(items)
+        return 200, {"answer": ans, "query_type": "airtable", "sql": None,
+                     "aggregations": {"type": "event_repeats", "items": items},
+                     "raw_results": [], "results_count": scanned, "next_cursor": None}
+
+    if kind == "chart_by_state":
+        labels, data_pts, total = aggregate_counts_by_state(state=state)
+        ans = "Photo counts by state (total %d)." % total
+        return 200, {"answer": ans, "query_type": "airtable", "sql": None,
+                     "chart": {"type": "bar", "labels": labels, "datasets": [{"label": "Photos", "data": data_pts}]},
+                     "raw_results": [], "results_count": total, "next_cursor": None}
+
+    if kind == "chart_by_employee_last":
+        labels, data_pts, total = aggregate_counts_by_employee_last_name(state=state)
+        ans = "Photo counts by employee last name (total %d)." % total
+        return 200, {"answer": ans, "query_type": "airtable", "sql": None,
+                     "chart": {"type": "bar", "labels": labels, "datasets": [{"label": "Photos", "data": data_pts}]},
+                     "raw_results": [], "results_count": total, "next_cursor": None}
+
+    if kind == "table_by_state":
+        labels, data_pts, total = aggregate_counts_by_state(state=state)
+        table_rows = [{"state": s, "count": c} for s, c in zip(labels, data_pts)]
+        ans = "Table of photo counts by state (total %d)." % total
+        return 200, {"answer": ans, "query_type": "airtable", "sql": None,
+                     "aggregations": {"type": "counts_by_state", "items": table_rows},
+                     "raw_results": [], "results_count": total, "next_cursor": None}
+
+    # Default: paged photos
+    cursor = data.get("cursor") or None
+    page_size = data.get("page_size")
+    try:
+        ps = int(page_size) if page_size else AIRTABLE_PAGE_SIZE_DEFAULT
+    except Exception:
+        ps = AIRTABLE_PAGE_SIZE_DEFAULT
+    ps = min(max(1, min(100, ps)), overall_limit)
+
+    fields = _projected_fields() if AIRTABLE_FIELDS_SLIM else None
+    rows, next_cursor = get_airtable_photos_page(state=state, page_size=ps, cursor=cursor, fields=fields)
+    human_state = state or "any state"
+    more = " (more available)" if next_cursor else ""
+    answer = "Returned %d photos from %s%s." % (len(rows), human_state, more)
+    return 200, {"answer": answer, "query_type": "airtable", "sql": None,
+                 "raw_results": rows, "results_count": len(rows), "next_cursor": next_cursor}
+
+def _execute_generated_sql(sql: str, conn=None) -> Tuple[int, Any]:
+    """(200, rows), or an error status and payload; `conn` is released either way."""
+    if not is_safe_select(sql):
+        if conn is not None:
+            _release_sql_conn(conn)
+        return 400, {"error": "Generated SQL failed safety checks", "sql": sql}
+    try:
+        return 200, run_sql(sql, conn=conn)
+    except Exception as db_e:
+        return 500, {"error": str(db_e), "trace": traceback.format_exc(), "sql": sql}
+
+def _batch_response(questions: List[str]) -> Dict[str, Any]:
+    """One result per question, in order; SQL questions share a batched generation call."""
+    kinds = [classify_question(q) for q in questions]
+    sql_idx = [i for i, k in enumerate(kinds) if k == "sql"]
+    generated: Dict[int, str] = {}
+    gen_error: Optional[Dict[str, Any]] = None
+    if sql_idx:
+        try:
+            generated = dict(zip(sql_idx, llm_generate_sql_batch([questions[i] for i in sql_idx])))
+        except Exception as e:
+            # Only the SQL-routed questions depend on the batch; Airtable ones still run.
+            gen_error = {"error": str(e), "trace": traceback.format_exc()}
+    results: List[Dict[str, Any]] = []
+    for i, (question, kind) in enumerate(zip(questions, kinds)):
+        try:
+            if kind != "sql":
+                status, payload = _airtable_response(kind, question, {})
+            elif gen_error is not None:
+                status, payload = 500, gen_error
+            else:
+                status, result = _execute_generated_sql(generated[i])
+                if status == 200:
+                    payload = {"answer": llm_format_answer(question, result), **_sql_results(generated[i], result)}
+                else:
+                    payload = result
+        except Exception as e:
+            status, payload = 500, {"error": str(e), "trace": traceback.format_exc()}
+        results.append({"question": question, "status": status, **payload})
+    return {"results": results}
+
 class handler(BaseHTTPRequestHandler):
+    # Every JSON response carries a Content-Length, so clients can keep the connection open.
+    protocol_version = "HTTP/1.1"
+    _COMMON_HEADERS = (("Access-Control-Allow-Origin", "*"), ("Cache-Control", "no-store"))
+
+    def _start(self, status: int, content_type: str, length: Optional[int] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in self._COMMON_HEADERS:
+            self.send_header(name, value)
+        if length is not None:
+            self.send_header("Content-Length", str(length))
+        if length is None or self.close_connection:
+            # The body is delimited by the close, or the request left unread bytes behind.
+            self.send_header("Connection", "close")
+        self.end_headers()  # status line and headers go out in one write
+
     def _send(self, status: int, payload: Dict[str, Any]):
         try:
-            body = json.dumps(payload).encode()
+            body = dumps_json(payload)
         except Exception as ser:
             body = json.dumps({"error": "serialization_failed", "detail": str(ser)}).encode()
             status = 500
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Cache-Control", "no-store")
-        self.end_headers()
+        self._start(status, "application/json", len(body))
         self.wfile.write(body)
 
+    def _send_stream(self, frames: Iterator[Dict[str, Any]]):
+        """NDJSON, one frame per line, flushed as produced; the body ends when the connection closes.
+        Once the status line is out every failure ends here, never in a second response."""
+        self.close_connection = True
+        try:
+            self._start(200, "application/x-ndjson")
+            for frame in frames:
+                self.wfile.write(dumps_json(frame) + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return  # client went away; nothing more can be written
+        except Exception as e:
+            try:
+                self.wfile.write(dumps_json({"type": "error", "error": str(e)}) + b"\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
     def do_OPTIONS(self):
         self.send_response(204)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Headers", "Content-Type, X-API-Key")
         self.send_header("Access-Control-Allow-Methods", "POST, GET, OPTIONS")
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
@@ -423,118 +1592,77 @@ class handler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         # Completely guarded parse
+        if self.headers.get("Transfer-Encoding"):
+            # Chunked bodies are not decoded; the unread chunks would be parsed as the next request.
+            self.close_connection = True
+            return self._send(411, {"error": "Content-Length required"})
+        if self.headers.get("Content-Length") is None:
+            # Any body would be unread and delimited only by the client's close.
+            self.close_connection = True
         try:
             length = int(self.headers.get("Content-Length") or 0)
-            raw = self.rfile.read(length).decode("utf-8") if length else "{}"
-            data = json.loads(raw or "{}")
+            if length < 0:
+                # rfile.read(-1) would block until the client hangs up.
+                raise ValueError("negative Content-Length")
+        except ValueError as e:
+            # The unread body would be parsed as the next request, so this connection ends here.
+            self.close_connection = True
+            return self._send(400, {"error": "Invalid Content-Length", "detail": str(e)})
+        try:
+            if length > MAX_BODY_BYTES:
+                # Decided from the header alone; the body is never read into memory.
+                self.close_connection = True
+                return self._send(413, {"error": "Body too large", "max_bytes": MAX_BODY_BYTES})
+            raw = self.rfile.read(length) if length else b""
+            data = loads_json(raw or b"{}")
+            if not isinstance(data, dict):
+                raise ValueError("expected a JSON object")
         except Exception as e:
             return self._send(400, {"error": "Invalid JSON", "detail": str(e)})
 
         # 1) System Test (no third-party imports)
         if data.get("test"):
+            if data.get("flush"):
+                # Next aggregation question rescans Airtable instead of waiting out AGG_CACHE_TTL.
+                _AGG_CACHE.clear()
             payload = {"ok": True, **config_status()}
-            if data.get("debug") == "airtable":
-                # Optional tiny Airtable probe, but guarded
-                try:
-                    recs, _ = _airtable_list_records(pageSize=1)  # intentionally small
-                    sample = []
-                    for r in recs:
-                        before = (r.get("fields") or {}).copy()
-                        after = (r.get("fields") or {}).copy()
-                        _normalize_photo_fields(after)
-                        sample.append({"before": before, "after": after})
-                    payload["airtable_sample"] = sample
-                except Exception as e:
-                    payload["airtable_sample"] = [{"error": str(e)}]
+            # Optional guarded probes: "airtable", "sql", or "all" (run concurrently)
+            payload.update(run_probes(data.get("debug")))
             return self._send(200, payload)
 
-        # 2) Real questions
+        # 2) Batch: {"questions": [...]} answered in order
+        batch = data.get("questions")
+        if batch is not None:
+            if not isinstance(batch, list) or not batch or not all(isinstance(q, str) and q.strip() for q in batch):
+                return self._send(400, {"error": "'questions' must be a non-empty list of strings"})
+            if len(batch) > MAX_BATCH_QUESTIONS:
+                return self._send(400, {"error": "Too many questions", "max_questions": MAX_BATCH_QUESTIONS})
+            try:
+                return self._send(200, _batch_response([q.strip() for q in batch]))
+            except Exception as e:
+                return self._send(500, {"error": str(e), "trace": traceback.format_exc()})
+
+        # 3) Real questions
         question = (data.get("question") or "").strip()
         if not question:
             return self._send(400, {"error": "Missing 'question'"})
 
-        ql = question.lower()
-        use_airtable = ("photo" in ql) or ("airtable" in ql) or ("event" in ql)
+        kind = classify_question(question)
 
         try:
-            if use_airtable:
-                state, overall_limit = parse_state_and_limit(question)
-
-                if is_employee_most_photos_intent(question):
-                    top, scanned = aggregate_top_employees(state=state, top_n=10)
-                    if not top:
-                        ans = "I didn’t find any photos."
-                    else:
-                        leader, leader_count = top[0]
-                        ans = "%s has the most photos with %d." % (leader, leader_count)
-                        if len(top) > 1:
-                            tail = "; ".join(["%s (%d)" % (n, c) for n, c in top[1:5]])
-                            if tail:
-                                ans += " Next: %s." % tail
-                    return self._send(200, {"answer": ans, "query_type": "airtable", "sql": None,
-                                             "raw_results": [], "results_count": scanned, "next_cursor": None})
-
-                if is_event_repeats_intent(question):
-                    items, scanned = aggregate_repeated_events(state=state, min_count=2, top_n=25)
-                    ans = "No events were found more than once." if not items else "Found %d events that occurred more than once." % len(items)
-                    return self._send(200, {"answer": ans, "query_type": "airtable", "sql": None,
-                                             "aggregations": {"type": "event_repeats", "items": items},
-                                             "raw_results": [], "results_count": scanned, "next_cursor": None})
-
-                if is_bar_chart_by_state_intent(question):
-                    labels, data_pts, total = aggregate_counts_by_state(state=state)
-                    ans = "Photo counts by state (total %d)." % total
-                    return self._send(200, {"answer": ans, "query_type": "airtable", "sql": None,
-                                             "chart": {"type": "bar", "labels": labels, "datasets": [{"label": "Photos", "data": data_pts}]},
-                                             "raw_results": [], "results_count": total, "next_cursor": None})
-
-                if is_bar_chart_by_employee_last_intent(question):
-                    labels, data_pts, total = aggregate_counts_by_employee_last_name(state=state)
-                    ans = "Photo counts by employee last name (total %d)." % total
-                    return self._send(200, {"answer": ans, "query_type": "airtable", "sql": None,
-                                             "chart": {"type": "bar", "labels": labels, "datasets": [{"label": "Photos", "data": data_pts}]},
-                                             "raw_results": [], "results_count": total, "next_cursor": None})
-
-                if is_table_counts_by_state_intent(question):
-                    labels, data_pts, total = aggregate_counts_by_state(state=state)
-                    table_rows = [{"state": s, "count": c} for s, c in zip(labels, data_pts)]
-                    ans = "Table of photo counts by state (total %d)." % total
-                    return self._send(200, {"answer": ans, "query_type": "airtable", "sql": None,
-                                             "aggregations": {"type": "counts_by_state", "items": table_rows},
-                                             "raw_results": [], "results_count": total, "next_cursor": None})
-
-                # Default: paged photos
-                cursor = data.get("cursor") or None
-                page_size = data.get("page_size")
-                try:
-                    ps_default = max(1, min(100, AIRTABLE_PAGE_SIZE_DEFAULT))
-                    ps = max(1, min(100, int(page_size))) if page_size else ps_default
-                except Exception:
-                    ps = max(1, min(100, AIRTABLE_PAGE_SIZE_DEFAULT))
-                ps = min(ps, overall_limit)
-
-                rows, next_cursor = get_airtable_photos_page(state=state, page_size=ps, cursor=cursor)
-                human_state = state or "any state"
-                more = " (more available)" if next_cursor else ""
-                answer = "Returned %d photos from %s%s." % (len(rows), human_state, more)
-                return self._send(200, {"answer": answer, "query_type": "airtable", "sql": None,
-                                         "raw_results": rows, "results_count": len(rows), "next_cursor": next_cursor})
+            if kind != "sql":
+                return self._send(*_airtable_response(kind, question, data))
 
             # SQL path
-            schema_hint = "(List allowed tables/views here)"
-            candidate_sql = llm_generate_sql(question, schema_hint)
-            if not is_safe_select(candidate_sql):
-                return self._send(400, {"error": "Generated SQL failed safety checks", "sql": candidate_sql})
-
-            try:
-                rows = run_sql(candidate_sql)
-            except Exception as db_e:
-                tb = traceback.format_exc()
-                return self._send(500, {"error": str(db_e), "trace": tb, "sql": candidate_sql})
+            candidate_sql, conn = generate_sql_with_connection(question)
+            status, rows = _execute_generated_sql(candidate_sql, conn)
+            if status != 200:
+                return self._send(status, rows)
 
+            if data.get("stream"):
+                return self._send_stream(_stream_sql_frames(question, candidate_sql, rows))
             answer = llm_format_answer(question, rows)
-            return self._send(200, {"answer": answer, "query_type": "sql", "sql": candidate_sql,
-                                     "raw_results": rows[:200], "results_count": len(rows), "next_cursor": None})
+            return self._send(200, {"answer": answer, **_sql_results(candidate_sql, rows)})
 
         except Exception as e:
             tb = traceback.format_exc()
@@ -543,25 +1671,45 @@ class handler(BaseHTTPRequestHandler):
 # -----------------------------
 # Parse state & limit
 # -----------------------------
+_STATE_PHRASE_RE = re.compile(
+    r"\b(?:from|in)\s+(%s)\b" % "|".join(sorted(STATE_NAME_TO_CODE, key=len, reverse=True)),
+    re.IGNORECASE)
+_STATE_CODE_RE = re.compile(r"\b(%s)\b" % "|".join(sorted(STATE_CODES)))
+# One pass for both limit forms: "top 5" / "last 10" or a bare "all".
+_LIMIT_RE = re.compile(r"\b(?:(?:past|last|first|top)\s+(\d+)|(all)\b)", re.IGNORECASE)
+
 def parse_state_and_limit(question: str) -> Tuple[Optional[str], int]:
-    m = re.search(r"\b(?:from|in)\s+(massachusetts|maine|rhode island|vermont|ma|me|ri|vt)\b", question, flags=re.IGNORECASE)
+    m = _STATE_PHRASE_RE.search(question)
     state: Optional[str] = None
     if m:
         state = STATE_NAME_TO_CODE[m.group(1).lower()]
     if not state:
-        m2 = re.search(r"\b(MA|ME|RI|VT)\b", question)
+        m2 = _STATE_CODE_RE.search(question)
         if m2:
-            state = m2.group(1).upper()
+            state = m2.group(1)
     limit: Optional[int] = None
-    m3 = re.search(r"\b(past|last|first|top)\s+(\d+)", question, flags=re.IGNORECASE)
-    if m3:
-        try:
-            limit = int(m3.group(2))
-        except Exception:
-            pass
-    if re.search(r"\ball\b", question, flags=re.IGNORECASE):
-        limit = AIRTABLE_MAX_LIMIT
+    for m3 in _LIMIT_RE.finditer(question):
+        if m3.group(2):
+            limit = AIRTABLE_MAX_LIMIT
+            break
+        if limit is None:
+            limit = int(m3.group(1))
     if limit is None:
         limit = AIRTABLE_DEFAULT_LIMIT
     limit = max(1, min(AIRTABLE_MAX_LIMIT, limit))
     return state, limit
+
+# -----------------------------
+# Local server (Vercel imports `handler` directly and never runs this)
+# -----------------------------
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", "8000"))
+    server = ThreadingHTTPServer(("", port), handler)
+    server.daemon_threads = True
+    print("Serving api/query on :%d" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
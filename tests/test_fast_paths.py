@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("LLM_CACHE_DB", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import query  # noqa: E402
+
+
+class SchemaQuestionTests(unittest.TestCase):
+    def test_tables(self):
+        for q in ("List all tables", "show me the tables?", "What tables are there?", "what are the tables"):
+            self.assertIn("INFORMATION_SCHEMA.TABLES", query.fast_path_sql(q), q)
+
+    def test_views(self):
+        for q in ("List views", "Which views exist?", "show all the views"):
+            self.assertIn("INFORMATION_SCHEMA.VIEWS", query.fast_path_sql(q), q)
+
+    def test_columns_of_table(self):
+        for q in ("What columns are in Applications?", "list the fields of table [Applications]",
+                  "show columns in the Applications table"):
+            sql = query.fast_path_sql(q)
+            self.assertIn("INFORMATION_SCHEMA.COLUMNS", sql, q)
+            self.assertIn("TABLE_NAME = 'Applications'", sql, q)
+
+
+class DataQuestionTests(unittest.TestCase):
+    def test_data_questions_go_to_the_model(self):
+        for q in (
+            "Show me the listings with the most views",
+            "What were total sales of dining tables last month?",
+            "How many applications have empty fields for each rep?",
+            "missing fields in the MA region",
+            "What fields are in the MA region?",
+            "Which reps updated tables or views this week?",
+        ):
+            self.assertIsNone(query.fast_path_sql(q), q)
+
+
+if __name__ == "__main__":
+    unittest.main()
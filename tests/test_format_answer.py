@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("LLM_CACHE_DB", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import query  # noqa: E402
+
+
+def _pairs(label, measure, values):
+    return [{label: k, measure: v} for k, v in values]
+
+
+class RankedAnswerTests(unittest.TestCase):
+    def test_lowest_keeps_sql_order(self):
+        rows = _pairs("rep", "sales", [("Cy", 3), ("Ann", 7), ("Bo", 12)])
+        answer = query.format_answer_directly("Which reps have the lowest sales?", rows)
+        self.assertEqual(answer, "sales by rep: Cy (3); Ann (7); Bo (12).")
+
+    def test_top_n_lists_every_row_with_n_from_question(self):
+        rows = _pairs("rep", "sales", [(str(i), 100 - i) for i in range(10)])
+        answer = query.format_answer_directly("Show the top 10 reps by sales", rows)
+        self.assertTrue(answer.startswith("Top 10 rep by sales: 0 (100); 1 (99);"))
+        self.assertIn("9 (91).", answer)
+
+
+class UnrankedAnswerTests(unittest.TestCase):
+    def test_which_count_list_is_not_truncated(self):
+        states = ["MA", "ME", "RI", "VT", "NH", "CT", "NY", "NJ", "PA", "DE"]
+        rows = _pairs("state", "n", [(st, i + 1) for i, st in enumerate(states)])
+        answer = query.format_answer_directly("Which states have applications?", rows)
+        self.assertEqual(answer.count("("), 10)
+        self.assertTrue(answer.startswith("n by state: MA (1); ME (2);"))
+
+    def test_single_column_list(self):
+        rows = [{"name": n} for n in ("Ann", "Bo", "Cy")]
+        answer = query.format_answer_directly("Which reps joined this year?", rows)
+        self.assertEqual(answer, "Found 3 results: Ann, Bo, Cy.")
+
+    def test_long_lists_go_to_the_summarizer(self):
+        rows = _pairs("rep", "sales", [(str(i), i) for i in range(query._DIRECT_LIST_MAX + 1)])
+        self.assertIsNone(query.format_answer_directly("sales per rep", rows))
+
+
+class NumberFormattingTests(unittest.TestCase):
+    def test_label_column_is_not_grouped(self):
+        rows = _pairs("Year", "n", [(2023, 5), (2024, 7)])
+        answer = query.format_answer_directly("applications per year", rows)
+        self.assertEqual(answer, "n by Year: 2023 (5); 2024 (7).")
+
+    def test_measure_column_is_grouped(self):
+        rows = _pairs("rep", "sales", [("Ann", 12500), ("Bo", 900)])
+        answer = query.format_answer_directly("sales per rep", rows)
+        self.assertEqual(answer, "sales by rep: Ann (12,500); Bo (900).")
+
+    def test_single_row_lookup_keeps_ids_raw(self):
+        rows = [{"AppID": 45874, "Zip": 5401, "Name": "Ann"}]
+        answer = query.format_answer_directly("show application 45874", rows)
+        self.assertEqual(answer, "Found 1 result: AppID: 45874; Zip: 5401; Name: Ann.")
+
+    def test_summarizer_sees_raw_values(self):
+        rows = [{"AppID": 45874, "Zip": 5401}]
+        text = query._summary_rows_text("application details", rows)
+        self.assertIn("45874", text)
+        self.assertNotIn("45,874", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+os.environ.setdefault("LLM_CACHE_DB", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import query  # noqa: E402
+
+
+class AllowedTests(unittest.TestCase):
+    def test_plain_select(self):
+        self.assertTrue(query.is_safe_select("SELECT TOP 100 Name, COUNT(*) AS n FROM Reps GROUP BY Name"))
+
+    def test_banned_word_inside_identifier(self):
+        self.assertTrue(query.is_safe_select("SELECT updated_at, created_by, deleted FROM Apps"))
+        self.assertTrue(query.is_safe_select("SELECT Name FROM Apps WHERE LastUpdate > '2024-01-01'"))
+
+    def test_banned_word_inside_quotes(self):
+        self.assertTrue(query.is_safe_select("SELECT [Update Date], \"Drop Off\" FROM Apps"))
+        self.assertTrue(query.is_safe_select("SELECT Name FROM Apps WHERE Note = 'please delete'"))
+
+
+class RejectedTests(unittest.TestCase):
+    def test_not_a_select(self):
+        for sql in ("", "UPDATE Apps SET a = 1", "WITH x AS (SELECT 1) DELETE FROM Apps", "  selectx FROM t"):
+            self.assertFalse(query.is_safe_select(sql), sql)
+
+    def test_select_into(self):
+        self.assertFalse(query.is_safe_select("SELECT * INTO Backup FROM Apps"))
+        self.assertFalse(query.is_safe_select("SELECT [a] INTO [Backup] FROM Apps"))
+
+    def test_stacked_statements(self):
+        self.assertFalse(query.is_safe_select("SELECT 1; DROP TABLE Apps"))
+        self.assertFalse(query.is_safe_select("SELECT 1;"))
+
+    def test_comment_hidden_keywords(self):
+        self.assertFalse(query.is_safe_select("SELECT 1 -- \nDROP TABLE Apps"))
+        self.assertFalse(query.is_safe_select("SELECT 1 /* x */ EXEC('x')"))
+        self.assertFalse(query.is_safe_select("SELECT 1/**/WAITFOR DELAY '0:0:5'"))
+
+    def test_procedures_and_rowset_functions(self):
+        self.assertFalse(query.is_safe_select("SELECT * FROM OPENROWSET('SQLNCLI', 'x', 'SELECT 1')"))
+        self.assertFalse(query.is_safe_select("SELECT xp_cmdshell FROM t"))
+
+    def test_unbalanced_quotes_and_brackets(self):
+        self.assertFalse(query.is_safe_select("SELECT [Name FROM Apps"))
+        self.assertFalse(query.is_safe_select("SELECT 'x FROM Apps"))
+        self.assertFalse(query.is_safe_select("SELECT COUNT(* FROM Apps"))
+
+
+if __name__ == "__main__":
+    unittest.main()
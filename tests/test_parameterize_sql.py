@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+from decimal import Decimal
+
+os.environ.setdefault("LLM_CACHE_DB", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import query  # noqa: E402
+
+
+def _statement(sql):
+    """The inner statement of the sp_executesql call, unescaped."""
+    inner = sql[len("EXEC sp_executesql N'"):sql.index("', N'")]
+    return inner.replace("''", "'").replace("%%", "%")
+
+
+class LiteralTests(unittest.TestCase):
+    def test_no_literals_is_unchanged(self):
+        sql = "SELECT TOP 100 Name FROM Reps ORDER BY Name"
+        self.assertEqual(query.parameterize_sql(sql), (sql, None))
+
+    def test_int_and_string_comparisons(self):
+        sql, params = query.parameterize_sql("SELECT * FROM Apps WHERE State = 'MA' AND Units > 3")
+        self.assertEqual(params, ("MA", 3))
+        self.assertIn("@p0 varchar(8000), @p1 int", sql)
+        self.assertEqual(_statement(sql), "SELECT * FROM Apps WHERE State = @p0 AND Units > @p1")
+        self.assertTrue(sql.endswith("@p0 = %s, @p1 = %s"))
+
+    def test_type_inference(self):
+        _, params = query.parameterize_sql("SELECT 1 FROM t WHERE a = 3000000000 AND b = -12.50 AND c = N'café'")
+        self.assertEqual(params, (3000000000, Decimal("-12.50"), "café"))
+        sql, _ = query.parameterize_sql("SELECT 1 FROM t WHERE a = 3000000000 AND b = -12.50 AND c = N'café'")
+        self.assertIn("@p0 bigint, @p1 decimal(4,2), @p2 nvarchar(4000)", sql)
+
+    def test_escaped_quote_in_value(self):
+        _, params = query.parameterize_sql("SELECT 1 FROM t WHERE Name = 'O''Brien'")
+        self.assertEqual(params, ("O'Brien",))
+
+    def test_like_pattern_and_percent(self):
+        sql, params = query.parameterize_sql("SELECT '100%' AS p FROM t WHERE Name NOT LIKE 'A%'")
+        self.assertEqual(params, ("A%",))
+        self.assertIn("N'SELECT ''100%%'' AS p FROM t WHERE Name NOT LIKE @p0'", sql)
+
+    def test_repeated_literal_shares_one_parameter(self):
+        sql, params = query.parameterize_sql(
+            "SELECT CASE WHEN Amount > 1000 THEN 'big' ELSE 'small' END AS bucket, COUNT(*) AS n "
+            "FROM Deals GROUP BY CASE WHEN Amount > 1000 THEN 'big' ELSE 'small' END")
+        self.assertEqual(params, (1000,))
+        self.assertEqual(_statement(sql).count("Amount > @p0"), 2)
+        self.assertNotIn("@p1", sql)
+
+    def test_decimal_beyond_max_precision_stays_inline(self):
+        tiny = "0." + "0" * 41 + "1"
+        sql, params = query.parameterize_sql("SELECT 1 FROM t WHERE a < %s AND b = 2" % tiny)
+        self.assertEqual(params, (2,))
+        self.assertIn("a < %s AND b = @p0" % tiny, _statement(sql))
+
+
+class LeftAloneTests(unittest.TestCase):
+    def test_comparison_inside_string(self):
+        sql = "SELECT 'a = 5' AS note FROM t"
+        self.assertEqual(query.parameterize_sql(sql), (sql, None))
+
+    def test_comparison_inside_comments(self):
+        sql = "SELECT a FROM t -- where a = 5, don't\n/* b = 'x' */"
+        self.assertEqual(query.parameterize_sql(sql), (sql, None))
+
+    def test_comparison_inside_identifiers(self):
+        sql = 'SELECT [a=5], "b = 6" FROM t'
+        self.assertEqual(query.parameterize_sql(sql), (sql, None))
+
+    def test_bracketed_column_is_still_compared(self):
+        sql, params = query.parameterize_sql("SELECT 1 FROM t WHERE [Unit Count] >= 2")
+        self.assertEqual(params, (2,))
+        self.assertEqual(_statement(sql), "SELECT 1 FROM t WHERE [Unit Count] >= @p0")
+
+
+if __name__ == "__main__":
+    unittest.main()
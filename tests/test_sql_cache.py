@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+from array import array
+
+os.environ.setdefault("LLM_CACHE_DB", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import query  # noqa: E402
+
+
+def _unit(*xs):
+    return array("b", [round(x * query._EMBED_SCALE) for x in xs])
+
+
+class SemanticHitTests(unittest.TestCase):
+    def setUp(self):
+        query._SQL_CACHE.clear()
+        self.vec = _unit(1.0, 0.0)
+
+    def tearDown(self):
+        query._SQL_CACHE.clear()
+
+    def test_same_specifics_hit(self):
+        query._sql_cache_store("how many applications in ma", self.vec, "SELECT 1")
+        self.assertEqual(query._sql_cache_lookup("count applications in massachusetts", self.vec), "SELECT 1")
+
+    def test_different_state_misses(self):
+        query._sql_cache_store("how many applications in ma", self.vec, "SELECT 1")
+        self.assertIsNone(query._sql_cache_lookup("how many applications in vt", self.vec))
+
+    def test_different_id_misses(self):
+        query._sql_cache_store("show application 45874", self.vec, "SELECT 1")
+        self.assertIsNone(query._sql_cache_lookup("show application 45875", self.vec))
+
+    def test_different_quoted_string_misses(self):
+        query._sql_cache_store('deals for "acme"', self.vec, "SELECT 1")
+        self.assertIsNone(query._sql_cache_lookup('deals for "globex"', self.vec))
+
+    def test_specifics(self):
+        self.assertEqual(query._question_specifics("top 5 reps in rhode island since 2023"), ("5", "RI", "2023"))
+
+
+class BestTests(unittest.TestCase):
+    def test_scoring_does_not_hold_the_lock(self):
+        cache = query._LRUCache(4)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # score() touching the cache would deadlock if best() scored under its lock.
+        self.assertEqual(cache.best(lambda v: cache.get("a") and v, 0), 2)
+
+    def test_hit_becomes_most_recent(self):
+        cache = query._LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 0)
+        cache.best(lambda v: v, 0)
+        cache.put("c", 0)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+
+
+if __name__ == "__main__":
+    unittest.main()